@@ -0,0 +1,449 @@
+# Бенчмарки whale_platform: python benchmarks.py <имя> [опции]
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from datetime import datetime, timezone
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bench")
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application, CallbackQueryHandler
+
+import whale_platform as wp
+
+PAIRS = [("ETH", "USD"), ("BTC", "RUB"), ("TON", "USDT"), ("RUB", "USDT"), ("SOL", "EUR")]
+
+def _measure(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    obj = build()
+    elapsed = time.perf_counter() - started
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return obj, size, elapsed
+
+def _synthetic_orders(n: int, users: int):
+    rnd = random.Random(42)
+    for i in range(n):
+        uid = 100000000 + rnd.randrange(users)
+        give, receive = rnd.choice(PAIRS)
+        amount = round(rnd.uniform(10, 5000), 2)
+        yield uid, i, give, receive, amount, amount * rnd.uniform(0.9, 1.1), amount * 0.0001
+
+# Память на заявку: словари (как раньше) против колоночного OrderStore
+def bench_orders(args):
+    orders = list(_synthetic_orders(args.orders, args.users))
+
+    def build_dicts():
+        db = {}
+        for uid, oid, give, receive, amount, final, fee in orders:
+            db.setdefault(uid, []).append({
+                "id": oid,
+                "from_coin": give,
+                "to_coin": receive,
+                "amount": float(repr(amount)),
+                "final_amount": float(repr(final)),
+                "fee": float(repr(fee)),
+                "contact": f"user{uid}",
+                "timestamp": datetime.now(timezone.utc).isoformat()
+            })
+        return db
+
+    def build_store():
+        store = wp.OrderStore(args.orders, args.orders, wp.ORDER_TTL)
+        for uid, oid, give, receive, amount, final, fee in orders:
+            store.add(uid, oid, give, receive, amount, final, fee, f"user{uid}", persist=False)
+        return store
+
+    _, dict_size, dict_time = _measure(build_dicts)
+    store, store_size, store_time = _measure(build_store)
+    print(f"orders: {args.orders}, users: {args.users}")
+    print(f"dicts:      {dict_size / args.orders:8.1f} B/order  build {dict_time:.2f}s")
+    print(f"OrderStore: {store_size / args.orders:8.1f} B/order  build {store_time:.2f}s  (records + book + per-user index)")
+    print(f"  records:  {store.record_bytes() / args.orders:8.1f} B/order")
+    print(f"ratio:      {dict_size / store_size:8.1f}x total, {dict_size / store.record_bytes():.1f}x records")
+
+# Время холодного старта: импорт модуля в отдельном процессе и load_db на синтетической базе.
+# С --max-import-ms/--max-load-ms завершается с кодом 1 при превышении — для CI
+def bench_startup(args):
+    env = {**os.environ, "TELEGRAM_BOT_TOKEN": os.environ["TELEGRAM_BOT_TOKEN"]}
+    code = "import time; t = time.perf_counter(); import whale_platform; print(time.perf_counter() - t)"
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, "-c", code], env=env, cwd=cwd, capture_output=True, text=True, check=True)
+        runs.append(float(out.stdout.strip().splitlines()[-1]) * 1000)
+    import_ms = statistics.median(runs)
+    print(f"import whale_platform: median {import_ms:.0f} ms, min {min(runs):.0f} ms ({args.runs} runs)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = wp.Store(os.path.join(tmp, "bench.db"))
+        db.open()
+        now = time.time()
+        rows = {}
+        for uid in range(100000000, 100000000 + args.users):
+            rows[("subs", uid)] = json.dumps(now + 86400)
+            rows[("memos", uid)] = json.dumps(wp.generate_memo(uid))
+            rows[("p2p_usage", uid)] = json.dumps(1)
+        for key, order in enumerate(_synthetic_orders(min(args.users, wp.ORDERS_MAX), args.users), 1):
+            uid, oid, give, receive, amount, final, fee = order
+            rows[("orders", key)] = json.dumps([uid, oid, give, receive, amount, final, fee, f"user{uid}", now])
+        db.write(rows)
+        db.close()
+        wp.store = wp.Store(os.path.join(tmp, "bench.db"))
+        started = time.perf_counter()
+        wp.load_db()
+        load_ms = (time.perf_counter() - started) * 1000
+        wp.store.close()
+    print(f"load_db: {load_ms:.0f} ms for {args.users} users")
+
+    failed = False
+    if args.max_import_ms and import_ms > args.max_import_ms:
+        print(f"FAIL: import {import_ms:.0f} ms > {args.max_import_ms} ms")
+        failed = True
+    if args.max_load_ms and load_ms > args.max_load_ms:
+        print(f"FAIL: load_db {load_ms:.0f} ms > {args.max_load_ms} ms")
+        failed = True
+    return 1 if failed else 0
+
+# === Нагрузка на обработчики ===
+# Настоящие обработчики гоняются через Application.process_update против локальных заглушек:
+# Bot API (getMe, sendMessage, editMessageText, ...) и API курсов (exchangerate-api, CoinGecko)
+
+def _cb(*args) -> str:
+    return "cb:" + wp.router.data(*args)
+
+USER_FLOW = [
+    "/start", _cb("p2p"), _cb("give", "ETH"), "1.5", _cb("recv", "USD"), _cb("pub"),
+    _cb("pay"), _cb("pt", "main"), _cb("plan", "main", 7), _cb("pm", "crypto"), _cb("pa", "TON")
+]
+
+class FakeServices:
+    def __init__(self, bot_latency: float, api_latency: float):
+        self.bot_latency = bot_latency
+        self.api_latency = api_latency
+        self.calls = {}
+        self._message_id = 0
+        self._runner = self._loop = self._thread = None
+        self.port = None
+
+    # заглушки крутятся в своём потоке со своим event loop, чтобы не делить CPU с ботом
+    def start(self):
+        ready = threading.Event()
+        self._loop = asyncio.new_event_loop()
+
+        async def serve():
+            app = web.Application()
+            app.router.add_post("/bot{token}/{method}", self._bot_api)
+            app.router.add_get("/v4/latest/USD", self._fiat)
+            app.router.add_get("/api/v3/simple/price", self._crypto)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, "127.0.0.1", 0)
+            await site.start()
+            self.port = site._server.sockets[0].getsockname()[1]
+            ready.set()
+
+        def run():
+            self._loop.run_until_complete(serve())
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="fake-services", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _message(self, chat_id, **extra):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id, "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"}, **extra
+        }
+
+    async def _bot_api(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        form = await request.post()
+        await asyncio.sleep(self.bot_latency)
+        chat_id = form.get("chat_id", 1)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "sendPhoto":
+            n = self._message_id
+            result = self._message(chat_id, photo=[{"file_id": f"photo{n}", "file_unique_id": f"u{n}", "width": 300, "height": 300}])
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=form.get("text", ""))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _fiat(self, request):
+        self.calls["fiat"] = self.calls.get("fiat", 0) + 1
+        await asyncio.sleep(self.api_latency)
+        rates = {"USD": 1.0, "EUR": 0.92, "RUB": 92.5, "UAH": 41.0, "KZT": 470.0, "CNY": 7.2, "GBP": 0.79}
+        return web.json_response({"base": "USD", "rates": {c: rates.get(c, 1.0) for c in wp.FIAT_CURRENCIES}})
+
+    async def _crypto(self, request):
+        self.calls["crypto"] = self.calls.get("crypto", 0) + 1
+        await asyncio.sleep(self.api_latency)
+        rnd = random.Random(request.query["ids"])
+        return web.json_response({cid: {"usd": round(rnd.uniform(0.1, 60000), 4)} for cid in request.query["ids"].split(",")})
+
+class FakeSheet:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.rows = 0
+
+    def append_rows(self, rows):
+        time.sleep(self.latency)
+        self.rows += len(rows)
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+
+def synthetic_update(update_id: int, uid: int, step: str) -> dict:
+    chat = {"id": uid, "type": "private"}
+    if step.startswith("cb:"):
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": _user(uid), "chat_instance": str(uid), "data": step[3:],
+            "message": {"message_id": update_id, "date": int(time.time()), "chat": chat, "text": "menu",
+                        "from": {"id": 1, "is_bot": True, "first_name": "bench"}}
+        }}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": _user(uid), "text": step}
+    if step.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(step.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def _handler_name(app: Application, update: Update) -> str:
+    if update.callback_query:
+        resolved = wp.router.resolve(update.callback_query.data)
+        return resolved[0].__name__ if resolved else "unrouted"
+    for handler in app.handlers.get(0, []):
+        if handler.check_update(update):
+            return getattr(handler.callback, "__name__", "?")
+    return "unhandled"
+
+def _percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _report(stats: dict, elapsed: float, fake: FakeServices):
+    total = sum(len(v) for v in stats.values())
+    print(f"{'handler':24} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'upd/s':>8}")
+    for name, lat in sorted(stats.items(), key=lambda kv: -len(kv[1])):
+        lat = [x * 1000 for x in lat]
+        print(f"{name:24} {len(lat):7} {_percentile(lat, 0.5):8.1f} {_percentile(lat, 0.95):8.1f} "
+              f"{_percentile(lat, 0.99):8.1f} {len(lat) / elapsed:8.0f}")
+    print(f"total: {total} updates in {elapsed:.2f}s, {total / elapsed:.0f} upd/s")
+    print("upstream calls: " + ", ".join(f"{k}={v}" for k, v in sorted(fake.calls.items())))
+
+class HandlerBench:
+    def __init__(self, args):
+        self.args = args
+        self.fake = FakeServices(args.bot_latency / 1000, args.api_latency / 1000)
+        self.stats = {}
+        self.app = None
+        self._tasks = []
+        self._tmp = None
+
+    async def __aenter__(self):
+        self.fake.start()
+        base = f"http://127.0.0.1:{self.fake.port}"
+        wp.FIAT_API_URL = f"{base}/v4/latest/USD"
+        wp.COINGECKO_API_URL = f"{base}/api/v3/simple/price"
+        self._tmp = tempfile.TemporaryDirectory()
+        wp.store = wp.Store(os.path.join(self._tmp.name, "bench.db"))
+        wp.store.open()
+        wp.sheet_writer.spill_path = os.path.join(self._tmp.name, "spill.jsonl")
+        wp.p2p_sheet = FakeSheet(self.args.api_latency / 1000)
+        await wp.http.start()
+        wp.sheet_writer.start()
+        if not self.args.cold_rates:
+            self._tasks.append(asyncio.create_task(wp.rate_refresher()))
+        builder = (
+            Application.builder().token(os.environ["TELEGRAM_BOT_TOKEN"])
+            .base_url(f"{base}/bot").base_file_url(f"{base}/file/bot").pool_timeout(30)
+            .concurrent_updates(wp.PerChatUpdateProcessor(wp.UPDATE_WORKERS))
+            .persistence(wp.StorePersistence(wp.PERSISTENCE_INTERVAL))
+            .updater(None)
+        )
+        if self.args.pool:
+            builder = builder.connection_pool_size(self.args.pool)
+        self.app = builder.build()
+        wp.register_handlers(self.app)
+        await self.app.initialize()
+        return self
+
+    async def __aexit__(self, *exc):
+        for task in self._tasks:
+            task.cancel()
+        await self.app.shutdown()
+        await wp.sheet_writer.stop()
+        await wp.http.close()
+        await wp.store.flush()
+        wp.store.close()
+        self.fake.stop()
+        self._tmp.cleanup()
+
+    async def dispatch(self, data: dict, since: float = None):
+        # since — момент, когда апдейт должен был прийти: в задержку входит и ожидание в очереди
+        started = since or time.perf_counter()
+        update = Update.de_json(data, self.app.bot)
+        name = _handler_name(self.app, update)
+        await self.app.update_processor.process_update(update, self.app.process_update(update))
+        self.stats.setdefault(name, []).append(time.perf_counter() - started)
+
+# Виртуальные пользователи проходят USER_FLOW, не больше --concurrency одновременно
+async def _run_handlers(args):
+    async with HandlerBench(args) as bench:
+        limit = asyncio.Semaphore(args.concurrency)
+        ids = iter(range(1, 10**9))
+
+        async def user(uid):
+            async with limit:
+                for step in USER_FLOW:
+                    await bench.dispatch(synthetic_update(next(ids), uid, step))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(200000000 + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+    _report(bench.stats, elapsed, bench.fake)
+
+def bench_handlers(args):
+    asyncio.run(_run_handlers(args))
+
+# Синтетический поток для replay: пользователи приходят с частотой --rate в секунду,
+# между шагами — пауза «на подумать» от 1 до --think секунд.
+# Реальный поток пишет сам бот при заданном UPDATES_LOG, формат тот же
+def bench_record(args):
+    rnd = random.Random(42)
+    events = []
+    arrival = 0.0
+    for i in range(args.users):
+        arrival += rnd.expovariate(args.rate)
+        t = arrival
+        for step in USER_FLOW:
+            events.append((t, 200000000 + i, step))
+            t += rnd.uniform(1, args.think)
+    events.sort()
+    with open(args.file, "w", encoding="utf-8") as f:
+        for update_id, (t, uid, step) in enumerate(events, 1):
+            f.write(json.dumps({"t": t, "update": synthetic_update(update_id, uid, step)}, ensure_ascii=False) + "\n")
+    print(f"{len(events)} updates from {args.users} users over {events[-1][0]:.0f}s -> {args.file}")
+
+async def _run_replay(args):
+    with open(args.file, encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    async with HandlerBench(args) as bench:
+        t0 = events[0]["t"]
+        started = time.perf_counter()
+        tasks = []
+        for event in events:
+            due = started + (event["t"] - t0) / args.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(bench.dispatch(event["update"], since=due)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    span = (events[-1]["t"] - t0) / args.speed
+    print(f"replay x{args.speed}: {len(events)} updates, planned {span:.1f}s, took {elapsed:.1f}s")
+    _report(bench.stats, elapsed, bench.fake)
+
+def bench_replay(args):
+    asyncio.run(_run_replay(args))
+
+# Стоимость выбора обработчика кнопки: цепочка CallbackQueryHandler с regex (как было)
+# против словаря CallbackRouter. Нажимается последняя кнопка — худший случай для цепочки
+def bench_callbacks(args):
+    async def noop(update, context, *args):
+        pass
+
+    print(f"{'routes':>7} {'regex chain ns':>15} {'router ns':>10}")
+    for n in args.routes:
+        handlers = [CallbackQueryHandler(noop, pattern=f"^menu{i}_") for i in range(n)]
+        router = wp.CallbackRouter()
+        for i in range(n):
+            router.route(f"m{i}", str)(noop)
+        legacy = Update.de_json(synthetic_update(1, 1, f"cb:menu{n - 1}_ETH"), None)
+        routed = Update.de_json(synthetic_update(2, 1, "cb:" + router.data(f"m{n - 1}", "ETH")), None)
+
+        def chain():
+            for handler in handlers:
+                if handler.check_update(legacy):
+                    return handler
+
+        def lookup():
+            return router.resolve(routed.callback_query.data)
+
+        chain_ns = min(timeit.repeat(chain, number=args.number, repeat=5)) / args.number * 1e9
+        router_ns = min(timeit.repeat(lookup, number=args.number, repeat=5)) / args.number * 1e9
+        print(f"{n:7} {chain_ns:15.0f} {router_ns:10.0f}")
+
+def _fake_args(p):
+    p.add_argument("--bot-latency", type=float, default=30, help="ms per Bot API call")
+    p.add_argument("--api-latency", type=float, default=150, help="ms per rate API / Sheets call")
+    p.add_argument("--concurrency", type=int, default=200)
+    p.add_argument("--pool", type=int, default=0, help="Bot API connection pool size (0 = library default, as in main)")
+    p.add_argument("--cold-rates", action="store_true", help="no background rate refresher")
+
+def main():
+    parser = argparse.ArgumentParser(description="whale_platform benchmarks")
+    sub = parser.add_subparsers(dest="name", required=True)
+
+    p = sub.add_parser("orders", help="memory per stored P2P order")
+    p.add_argument("--orders", type=int, default=100000)
+    p.add_argument("--users", type=int, default=20000)
+    p.set_defaults(func=bench_orders)
+
+    p = sub.add_parser("startup", help="cold import time and load_db time")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--users", type=int, default=50000)
+    p.add_argument("--max-import-ms", type=float, default=0)
+    p.add_argument("--max-load-ms", type=float, default=0)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("handlers", help="latency and throughput of real handlers against fake Bot API")
+    p.add_argument("--users", type=int, default=1000)
+    _fake_args(p)
+    p.set_defaults(func=bench_handlers)
+
+    p = sub.add_parser("record", help="write a synthetic update stream for replay")
+    p.add_argument("--file", default="updates.jsonl")
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--rate", type=float, default=5, help="new users per second")
+    p.add_argument("--think", type=float, default=8, help="max seconds between steps")
+    p.set_defaults(func=bench_record)
+
+    p = sub.add_parser("replay", help="replay a recorded update stream at N x speed")
+    p.add_argument("--file", default="updates.jsonl")
+    p.add_argument("--speed", type=float, default=1)
+    _fake_args(p)
+    p.set_defaults(func=bench_replay)
+
+    p = sub.add_parser("callbacks", help="callback dispatch cost: regex handler chain vs CallbackRouter")
+    p.add_argument("--routes", type=int, nargs="+", default=[13, 100, 1000])
+    p.add_argument("--number", type=int, default=2000)
+    p.set_defaults(func=bench_callbacks)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
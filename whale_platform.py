@@ -1,23 +1,39 @@
 import asyncio
 import aiohttp
+import functools
+import heapq
+import html
+import numpy as np
 import logging
 import json
+import math
 import os
+import random
 import re
+import sqlite3
+import sys
+import threading
+import time
+import warnings
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
 from io import BytesIO
+from typing import NamedTuple
+from urllib.parse import urlsplit
 
 from dotenv import load_dotenv
 load_dotenv()
 
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, ContextTypes,
-    CallbackQueryHandler, filters
+    BasePersistence, BaseUpdateProcessor, CallbackQueryHandler, PersistenceInput, TypeHandler, filters
 )
-from google.oauth2.service_account import Credentials
-import gspread
-import qrcode
 
 # === НАСТРОЙКИ ===
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -26,6 +42,12 @@ if not TELEGRAM_BOT_TOKEN:
 
 GOOGLE_SHEET_ID = os.getenv("GOOGLE_SHEET_ID", "1IyLZ5kopVWzA7vpvkcdDXXyBw3M9paR0IOARuKVAmLo")
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "383302760"))
+DB_PATH = os.getenv("DB_PATH", "whale.db")
+WORKER_ID = int(os.getenv("WORKER_ID", "0"))  # 0..15; фоновые задачи (рассылки, подписки) идут только на 0
+SHARED_STATE = os.getenv("SHARED_STATE", "0") == "1"  # несколько воркеров на одной базе DB_PATH
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "1"))  # сек. между сбросами user_data
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "5"))  # сек., подтягивание чужих изменений (заявки, подписки)
+CHANGES_KEEP = float(os.getenv("CHANGES_KEEP", "3600"))  # сек. хранения журнала изменений при SHARED_STATE
 
 NICEGRAM_ID = "6939917410"
 TAXOBOT_USERNAME = "@taxobot"
@@ -58,50 +80,619 @@ NETWORK_NAMES = {
 STARS_TO_RUB = 1.75  # 100 ⭐ = 175 RUB
 STARS_TO_USD = 1.75 / 93.5
 
+# === ТАРИФЫ ===
+MAIN_PLANS = [(3, 500), (7, 1000), (14, 1800), (30, 3500)]  # (дней, ⭐)
+P2P_PLANS = [("30d", 30, "Пробный"), ("90d", 100, "3 мес"), ("180d", 280, "6 мес")]  # (id, ⭐, описание)
+
 # === ВАЛЮТЫ ===
 FIAT_CURRENCIES = ["USD", "EUR", "RUB", "BYN", "KZT", "CNY", "JPY", "GBP"]
 CRYPTO_ASSETS = ["BTC", "ETH", "TON", "SOL", "DOGE", "XRP", "USDT", "USDC", "MNT", "TRX"]
 ALL_ASSETS = FIAT_CURRENCIES + CRYPTO_ASSETS
 
+COINGECKO_IDS = {
+    "BTC": "bitcoin", "ETH": "ethereum", "TON": "the-open-network",
+    "SOL": "solana", "DOGE": "dogecoin", "XRP": "ripple",
+    "USDT": "tether", "USDC": "usd-coin", "MNT": "mantle", "TRX": "tron"
+}
+
+# === КЭШ КУРСОВ ===
+RATE_CACHE_TTL = float(os.getenv("RATE_CACHE_TTL", "60"))  # сек., курс считается свежим
+RATE_CACHE_STALE = float(os.getenv("RATE_CACHE_STALE", "600"))  # сек., отдаём устаревший курс и обновляем в фоне
+RATE_REFRESH_INTERVAL = float(os.getenv("RATE_REFRESH_INTERVAL", "60"))  # сек., фоновое обновление матрицы курсов
+RATE_MAX_AGE = float(os.getenv("RATE_MAX_AGE", "300"))  # сек., старше — пересчёт прямо в обработчике
+
+# === ИСТОРИЯ КУРСОВ ===
+HISTORY_PATH = os.getenv("HISTORY_PATH", "")  # префикс файлов истории; пусто — только в памяти
+HISTORY_MINUTES = int(os.getenv("HISTORY_MINUTES", "1440"))  # минутных корзин (сутки)
+HISTORY_HOURS = int(os.getenv("HISTORY_HOURS", str(24 * 90)))  # часовых корзин
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", str(365 * 2)))  # дневных корзин
+
+# === HTTP ===
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", "10"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "5"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+FIAT_API_URL = os.getenv("FIAT_API_URL", "https://api.exchangerate-api.com/v4/latest/USD")
+COINGECKO_API_URL = os.getenv("COINGECKO_API_URL", "https://api.coingecko.com/api/v3/simple/price")
+
+# === ПОДПИСКИ ===
+SUB_REMIND_BEFORE = float(os.getenv("SUB_REMIND_BEFORE", str(24 * 3600)))  # сек. до окончания для напоминания
+
+# === РАССЫЛКА ===
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # сообщений в секунду на всех (лимит Telegram ~30)
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", "1"))  # сек. между сообщениями в один чат
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "16"))
+BROADCAST_RETRIES = int(os.getenv("BROADCAST_RETRIES", "3"))
+
+# === ОБНОВЛЕНИЯ ===
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "64"))  # апдейтов обрабатывается одновременно
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес; если не задан — long polling
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+UPDATES_LOG = os.getenv("UPDATES_LOG")  # JSONL-файл для записи входящих апдейтов (нагрузочные тесты)
+if SHARED_STATE and not WEBHOOK_URL:
+    # getUpdates допускает одного получателя: остальные воркеры ловили бы 409 Conflict
+    raise ValueError("❌ SHARED_STATE работает только с WEBHOOK_URL.")
+
+# === P2P ===
+ORDER_TTL = float(os.getenv("ORDER_TTL", str(7 * 24 * 3600)))  # сек., срок жизни заявки в подборе
+ORDERS_MAX = int(os.getenv("ORDERS_MAX", "200000"))  # всего заявок в памяти и на диске
+ORDERS_PER_USER = int(os.getenv("ORDERS_PER_USER", "20"))
+
+# === ОПЛАТЫ ===
+PAYMENT_SOURCES = os.getenv("PAYMENT_SOURCES", "")  # через запятую: toncenter, file:/path/payments.jsonl
+PAYMENT_POLL_INTERVAL = float(os.getenv("PAYMENT_POLL_INTERVAL", "30"))  # сек. между опросами источников
+PAYMENT_TOLERANCE = float(os.getenv("PAYMENT_TOLERANCE", "0.02"))  # допустимая недоплата из-за курса и комиссий
+INVOICE_TTL = float(os.getenv("INVOICE_TTL", str(24 * 3600)))  # сек., сколько ждём оплату по счёту
+TONCENTER_API_URL = os.getenv("TONCENTER_API_URL", "https://toncenter.com/api/v3")
+TONCENTER_API_KEY = os.getenv("TONCENTER_API_KEY", "")
+
+# === АНАЛИТИКА ===
+STATS_DIGEST_HOUR = int(os.getenv("STATS_DIGEST_HOUR", "9"))  # час UTC ежедневной сводки в ADMIN_CHAT_ID; -1 — не слать
+STATS_KEEP_DAYS = int(os.getenv("STATS_KEEP_DAYS", "35"))  # дней хранятся дневные счётчики
+
+# === QR ===
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", "256"))  # готовых PNG в памяти
+
+# === МЕТРИКИ ===
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # /metrics на METRICS_PORT + WORKER_ID; 0 — выключено
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+PROFILE_SAMPLE_HZ = float(os.getenv("PROFILE_SAMPLE_HZ", "0"))  # сэмплов стека в секунду для /debug/profile; 0 — выключено
+
+# === СИГНАЛЫ ===
+WHALE_SOURCES = os.getenv("WHALE_SOURCES", "")  # через запятую: file:/path/txs.jsonl, tcp:host:port
+WHALE_THRESHOLD_USD = float(os.getenv("WHALE_THRESHOLD_USD", "500000"))
+WHALE_EXCHANGE_MIN_USD = float(os.getenv("WHALE_EXCHANGE_MIN_USD", "100000"))  # порог для входов на биржи
+WHALE_DEDUP_SIZE = int(os.getenv("WHALE_DEDUP_SIZE", "200000"))  # последних транзакций помним для дедупликации
+WHALE_QUEUE_SIZE = int(os.getenv("WHALE_QUEUE_SIZE", "64"))  # пачек в очереди между источниками и фильтром
+WHALE_BATCH_SIZE = int(os.getenv("WHALE_BATCH_SIZE", "1000"))
+WHALE_MAX_AGE = float(os.getenv("WHALE_MAX_AGE", "3600"))  # сек.; более старые транзакции не сигналим
+EXCHANGE_ADDRESSES_FILE = os.getenv("EXCHANGE_ADDRESSES_FILE", "exchanges.json")
+EXCHANGE_ADDRESSES = {
+    "0x28c6c06298d514db089934071355e5743bf21d60": "Binance",
+    "0x21a31ee1afc51d94c2efccaa2092ad1028285549": "Binance",
+    "0xdfd5293d8e347dfe59e90efd55b2956a1343963d": "Binance",
+    "0x71660c4005ba85c37ccec55d0c4493e66fe775d3": "Coinbase",
+    "0x503828976d22510aad0201ac7ec88293211d23da": "Coinbase",
+    "0xa9d1e08c7793af67e9d92fe308d5697fb81d3e43": "Coinbase",
+}
+
 # === ГЛОБАЛЬНЫЕ ДАННЫЕ ===
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
 subs_db = {}
 p2p_subs_db = {}
 user_memos = {}
 p2p_usage = {}
-exchange_orders = {}
+qr_file_ids = {}  # платёжный URI -> file_id уже загруженного в Telegram QR
+trials = {}  # user_id -> срок пробного периода; совпадает с subs_db, пока пользователь не оплатил
+blocked_users = {}  # user_id -> когда бот был заблокирован пользователем
+invoices = {}  # memo -> ожидающий оплаты счёт; у пользователя один memo, значит и счёт один
+payment_cursors = {}  # источник платежей -> докуда прочитан
+whale_cursors = {}  # файловый источник транзакций -> докуда прочитан
+
+# === МЕТРИКИ ===
+# Счётчики и гистограммы в формате Prometheus. Пишут в них и event loop, и потоки
+# (store, sheets), поэтому под блокировкой; текст собирается только по запросу /metrics
+class Metrics:
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # имя -> (тип, описание, границы корзин)
+        self._counters = {}  # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [счётчики корзин..., сумма, количество]
+        self._gauges = {}  # имя -> функция без аргументов, возвращает число или {метки: число}
+
+    def counter(self, name: str, help: str):
+        self._meta[name] = ("counter", help, None)
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help, buckets)
+
+    def gauge(self, name: str, help: str, fn):
+        self._meta[name] = ("gauge", help, None)
+        self._gauges[name] = fn
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * (len(buckets) + 3)
+            h[bisect_left(buckets, value)] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def timer(self, name: str, **labels):
+        return _Timer(self, name, labels)
+
+    @staticmethod
+    def _labels(labels, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels] + ([extra] if extra else [])
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        lines = []
+        for name, (kind, help, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                lines += [f"{name}{self._labels(l)} {v}" for (n, l), v in counters.items() if n == name]
+            elif kind == "histogram":
+                for (n, l), h in histograms.items():
+                    if n != name:
+                        continue
+                    total = 0
+                    for bound, count in zip(buckets + ("+Inf",), h):
+                        total += count
+                        le = f'le="{bound}"'
+                        lines.append(f"{name}_bucket{self._labels(l, le)} {total}")
+                    lines.append(f"{name}_sum{self._labels(l)} {h[-2]}")
+                    lines.append(f"{name}_count{self._labels(l)} {h[-1]}")
+            else:
+                try:
+                    value = self._gauges[name]()
+                except Exception as e:
+                    logging.warning(f"Gauge {name} failed: {e}")
+                    continue
+                values = value if isinstance(value, dict) else {(): value}
+                lines += [f"{name}{self._labels(l)} {v}" for l, v in values.items()]
+        return "\n".join(lines) + "\n"
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "started")
+
+    def __init__(self, metrics: Metrics, name: str, labels: dict):
+        self.metrics, self.name, self.labels = metrics, name, labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+metrics = Metrics()
+metrics.histogram("bot_handler_seconds", "Время обработчика апдейта")
+metrics.counter("bot_handler_errors_total", "Исключения в обработчиках")
+metrics.histogram("bot_upstream_seconds", "Время запросов к внешним API, с повторами")
+metrics.counter("bot_upstream_retries_total", "Повторы запросов к внешним API")
+metrics.counter("bot_upstream_errors_total", "Неудачные запросы к внешним API")
+metrics.counter("bot_rate_cache_total", "Обращения к кэшу курсов: hit, stale, miss")
+metrics.counter("bot_qr_cache_total", "Запросы QR: file_id, png, render")
+metrics.histogram("bot_store_write_seconds", "Запись пачки изменений в SQLite")
+metrics.counter("bot_store_errors_total", "Ошибки записи в SQLite")
+metrics.histogram("bot_sheets_append_seconds", "Отправка пачки строк в Google Sheets")
+metrics.counter("bot_sheets_errors_total", "Ошибки отправки в Google Sheets")
+metrics.counter("bot_payments_total", "Входящие платежи: credited, partial, mismatch, unmatched, invalid")
+
+# Время и исключения каждого обработчика; имя — как у исходной функции
+def instrumented(callback, name: str):
+    @functools.wraps(callback)
+    async def wrapper(update, context, *args):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context, *args)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+    return wrapper
+
+# Сэмплирующий профилировщик: PROFILE_SAMPLE_HZ раз в секунду снимает стек потока с event loop.
+# /debug/profile отдаёт стеки в свёрнутом формате (flamegraph.pl, speedscope)
+class SamplingProfiler:
+    def __init__(self, hz: float):
+        self.interval = 1 / hz
+        self.samples = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._target = None
+        self._thread = None
+
+    def start(self):
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            with self._lock:
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def folded(self, reset: bool = False) -> str:
+        with self._lock:
+            samples = self.samples
+            if reset:
+                self.samples = {}
+            rows = sorted(samples.items(), key=lambda kv: -kv[1])
+        return "".join(f"{stack} {count}\n" for stack, count in rows)
+
+profiler = SamplingProfiler(PROFILE_SAMPLE_HZ) if PROFILE_SAMPLE_HZ > 0 else None
 
 # === GOOGLE SHEETS ===
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+SHEETS_BATCH_SIZE = int(os.getenv("SHEETS_BATCH_SIZE", "50"))
+SHEETS_FLUSH_INTERVAL = float(os.getenv("SHEETS_FLUSH_INTERVAL", "5"))  # сек.
+SHEETS_BUFFER_MAX = int(os.getenv("SHEETS_BUFFER_MAX", "1000"))  # строк в памяти, остальное — в файл
+SHEETS_SPILL_PATH = os.getenv("SHEETS_SPILL_PATH", f"sheets_spill_{WORKER_ID}.jsonl" if WORKER_ID else "sheets_spill.jsonl")
 sheet = p2p_sheet = None
-try:
-    creds = Credentials.from_service_account_file("credentials.json", scopes=SCOPES)
-    gc = gspread.authorize(creds)
-    sheet = gc.open_by_key(GOOGLE_SHEET_ID).sheet1
+
+# Подключение к таблице выполняется в фоне при запуске (в отдельном потоке),
+# до этого SheetWriter просто копит строки
+def init_sheets():
+    global sheet, p2p_sheet
     try:
-        p2p_sheet = gc.open_by_key(GOOGLE_SHEET_ID).worksheet("P2P")
-    except:
-        p2p_sheet = gc.open_by_key(GOOGLE_SHEET_ID).add_worksheet(title="P2P", rows="1000", cols="8")
-        p2p_sheet.append_row(["Дата", "User ID", "От", "К", "Сумма", "Контакт", "Комиссия", "Кошелёк комиссии"])
-except Exception as e:
-    logging.error(f"Google Sheets error: {e}")
+        import gspread
+        from google.oauth2.service_account import Credentials
+        creds = Credentials.from_service_account_file("credentials.json", scopes=SCOPES)
+        book = gspread.authorize(creds).open_by_key(GOOGLE_SHEET_ID)
+        sheet = book.sheet1
+        try:
+            p2p_sheet = book.worksheet("P2P")
+        except gspread.WorksheetNotFound:
+            p2p_sheet = book.add_worksheet(title="P2P", rows="1000", cols="8")
+            p2p_sheet.append_row(["Дата", "User ID", "От", "К", "Сумма", "Контакт", "Комиссия", "Кошелёк комиссии"])
+    except Exception as e:
+        logging.error(f"Google Sheets error: {e}")
+
+# Отложенная запись в таблицу: строки копятся в памяти и уходят пачкой
+# append_rows из рабочего потока; при переполнении и остановке — в файл
+class SheetWriter:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, get_sheet, batch_size: int, interval: float, max_buffer: int, spill_path: str):
+        self.get_sheet = get_sheet
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.spill_path = spill_path
+        self.buffer = deque()
+        self._spilled = 0
+        self._offset = 0
+        self._appending = False
+        self._stopping = False
+        self._cutoff = False
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def enqueue(self, row: list):
+        # пока в файле есть строки, новые тоже идут туда — порядок сохраняется
+        if self._spilled or len(self.buffer) >= self.max_buffer:
+            self._spill([row])
+        else:
+            self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        if os.path.exists(self.spill_path):
+            with open(self.spill_path, "rb") as f:
+                try:
+                    with open(self.spill_path + ".offset") as o:
+                        self._offset = int(o.read())
+                except (OSError, ValueError):
+                    self._offset = 0
+                if self._offset > os.fstat(f.fileno()).st_size:
+                    self._offset = 0
+                f.seek(self._offset)
+                self._spilled = sum(1 for _ in f)
+        self._restore()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        if self._task:
+            done, _ = await asyncio.wait({self._task}, timeout=self.interval)
+            if not done:
+                # начатую пачку дожидаемся: иначе её строки попали бы и в таблицу, и в файл
+                self._cutoff = True
+                if self._appending:
+                    await self._task
+                else:
+                    self._task.cancel()
+            self._task = None
+        if self.buffer:
+            rows = list(self.buffer)
+            self.buffer.clear()
+            self._spill(rows, front=True)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if self._stopping:
+                return
+
+    async def flush(self):
+        backoff = 1
+        while self.buffer and not self._cutoff:
+            sheet = self.get_sheet()
+            if sheet is None:
+                return
+            batch = [self.buffer[i] for i in range(min(self.batch_size, len(self.buffer)))]
+            self._appending = True
+            try:
+                with metrics.timer("bot_sheets_append_seconds"):
+                    await asyncio.to_thread(sheet.append_rows, batch)
+            except Exception as e:
+                metrics.inc("bot_sheets_errors_total")
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if status is not None and status not in self.RETRY_STATUSES:
+                    logging.error(f"Sheets append rejected ({status}), dropping {len(batch)} rows: {e}")
+                else:
+                    logging.warning(f"Sheets append failed, retry in {backoff}s: {e}")
+                    if self._stopping:
+                        return
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 60)
+                    continue
+            finally:
+                self._appending = False
+            for _ in batch:
+                self.buffer.popleft()
+            backoff = 1
+            self._restore()
+
+    def _spill(self, rows: list, front: bool = False):
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode("utf-8")
+        if front and self._spilled:
+            # только при остановке: файл переписывается один раз, с начала непрочитанной части
+            with open(self.spill_path, "rb") as f:
+                f.seek(self._offset)
+                data += f.read()
+            with open(self.spill_path, "wb") as f:
+                f.write(data)
+            self._save_offset(0)
+        else:
+            with open(self.spill_path, "ab") as f:
+                f.write(data)
+        self._spilled += len(rows)
+
+    def _restore(self):
+        # читаем не больше room строк с сохранённого смещения — файл целиком не перечитывается
+        room = min(self.max_buffer - len(self.buffer), self._spilled)
+        if room <= 0:
+            return
+        with open(self.spill_path, "rb") as f:
+            f.seek(self._offset)
+            self.buffer.extend(json.loads(f.readline()) for _ in range(room))
+            offset = f.tell()
+        self._spilled -= room
+        if self._spilled:
+            self._save_offset(offset)
+        else:
+            os.remove(self.spill_path)
+            self._save_offset(0)
+
+    def _save_offset(self, offset: int):
+        self._offset = offset
+        if offset:
+            with open(self.spill_path + ".offset", "w") as f:
+                f.write(str(offset))
+        elif os.path.exists(self.spill_path + ".offset"):
+            os.remove(self.spill_path + ".offset")
+
+sheet_writer = SheetWriter(lambda: p2p_sheet, SHEETS_BATCH_SIZE, SHEETS_FLUSH_INTERVAL, SHEETS_BUFFER_MAX, SHEETS_SPILL_PATH)
+metrics.gauge("bot_sheets_buffer", "Строк в очереди на отправку в Sheets", lambda: len(sheet_writer.buffer))
+
+# === ХРАНИЛИЩЕ ===
+# SQLite в режиме WAL: каждая запись — отдельная строка (таблица, ключ),
+# изменения копятся и пишутся одной транзакцией в отдельном потоке
+class Store:
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+
+    def open(self):
+        if self._conn is not None:
+            return
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            "tbl TEXT NOT NULL, key NOT NULL, value TEXT NOT NULL, PRIMARY KEY (tbl, key)"
+            ") WITHOUT ROWID"
+        )
+        # журнал изменений для SHARED_STATE: номер выдаётся под блокировкой записи SQLite,
+        # поэтому растёт в порядке коммитов и запоздавшая транзакция не будет пропущена
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS changes ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, tbl TEXT NOT NULL, key NOT NULL)"
+        )
+        self._conn = conn
+
+    @contextmanager
+    def snapshot(self):
+        # все чтения внутри одной транзакции видят один и тот же снимок базы (WAL)
+        with self._lock:
+            self._conn.execute("BEGIN")
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._conn.execute("COMMIT")
+
+    def last_change(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def load(self, tbl: str) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM kv WHERE tbl = ?", (tbl,)).fetchall()
+        # один вызов парсера на всю таблицу вместо json.loads на каждую строку
+        values = json.loads("[" + ",".join(value for _, value in rows) + "]")
+        return {key: value for (key, _), value in zip(rows, values)}
+
+    def read(self, keys: list) -> dict:
+        found = {}
+        with self._lock:
+            for tbl, key in keys:
+                row = self._conn.execute("SELECT value FROM kv WHERE tbl = ? AND key = ?", (tbl, key)).fetchone()
+                if row:
+                    found[(tbl, key)] = json.loads(row[0])
+        return found
+
+    async def fetch(self, keys: list) -> dict:
+        # ещё не записанные изменения этого процесса свежее того, что лежит на диске
+        pending = {k: self._pending[k] for k in keys if k in self._pending}
+        found = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self.read, [k for k in keys if k not in pending]
+        )
+        found.update({k: json.loads(v) for k, v in pending.items() if v is not None})
+        return found
+
+    async def changes_since(self, seq: int) -> tuple:
+        # текущие значения записей, изменённых после seq; None — запись удалена
+        def read():
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT c.seq, c.tbl, c.key, kv.value FROM changes c "
+                    "LEFT JOIN kv ON kv.tbl = c.tbl AND kv.key = c.key WHERE c.seq > ? ORDER BY c.seq", (seq,)
+                ).fetchall()
+            changed = {(tbl, key): value and json.loads(value) for _, tbl, key, value in rows}
+            return (rows[-1][0] if rows else seq), changed
+        return await asyncio.get_running_loop().run_in_executor(self._executor, read)
+
+    async def prune_changes(self, seq: int):
+        def prune():
+            with self._lock, self._conn:
+                self._conn.execute("DELETE FROM changes WHERE seq <= ?", (seq,))
+        await asyncio.get_running_loop().run_in_executor(self._executor, prune)
+
+    def put(self, tbl: str, key, value):
+        self._pending[(tbl, key)] = None if value is None else json.dumps(value)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_pending())
+
+    def delete(self, tbl: str, key):
+        self.put(tbl, key, None)
+
+    async def flush(self):
+        while self._flusher is not None and not self._flusher.done():
+            await self._flusher
+
+    async def _flush_pending(self):
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch, self._pending = self._pending, {}
+            try:
+                await loop.run_in_executor(self._executor, self.write, batch)
+            except Exception as e:
+                metrics.inc("bot_store_errors_total")
+                logging.error(f"Store write error: {e}")
+                self._pending = {**batch, **self._pending}
+                await asyncio.sleep(1)
+
+    def write(self, batch: dict):
+        upserts = [(tbl, key, value) for (tbl, key), value in batch.items() if value is not None]
+        deletes = [(tbl, key) for (tbl, key), value in batch.items() if value is None]
+        with metrics.timer("bot_store_write_seconds"), self._lock, self._conn:
+            if upserts:
+                self._conn.executemany("INSERT OR REPLACE INTO kv (tbl, key, value) VALUES (?, ?, ?)", upserts)
+            if deletes:
+                self._conn.executemany("DELETE FROM kv WHERE tbl = ? AND key = ?", deletes)
+            if SHARED_STATE:
+                self._conn.executemany("INSERT INTO changes (tbl, key) VALUES (?, ?)", list(batch))
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+store = Store(DB_PATH)
+
+DB_TABLES = {
+    "subs": subs_db, "p2p_subs": p2p_subs_db, "memos": user_memos, "p2p_usage": p2p_usage,
+    "qr_file_ids": qr_file_ids, "trials": trials, "blocked": blocked_users,
+    "invoices": invoices, "payment_cursors": payment_cursors, "whale_cursors": whale_cursors
+}
+metrics.gauge("bot_store_pending", "Изменений ждут записи в SQLite", lambda: len(store._pending))
+metrics.gauge("bot_records", "Записей в таблицах", lambda: {(("table", t),): len(d) for t, d in DB_TABLES.items()})
 
 # === ФУНКЦИИ ===
 def load_db():
-    files = [("subs.json", subs_db), ("p2p_subs.json", p2p_subs_db), ("memos.json", user_memos), ("p2p_usage.json", p2p_usage)]
-    for fname, var in files:
-        if os.path.exists(fname):
-            try:
-                with open(fname, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    var.update({int(k): v for k, v in data.items()})
-            except: pass
+    store.open()
+    price_history.open()
+    analytics.load()
+    # таблицы и номер последнего изменения — из одного снимка, чтобы синхронизация
+    # продолжила ровно с того места, на котором закончилась загрузка
+    with store.snapshot():
+        state_sync.seq = store.last_change()
+        orders = store.load("orders")
+        for tbl, var in DB_TABLES.items():
+            var.update(store.load(tbl))
+    exchange_orders.load(orders)
+    for tbl, var in DB_TABLES.items():
+        fname = f"{tbl}.json"
+        if var or not os.path.exists(fname):
+            continue
+        # одноразовый перенос старых JSON-файлов
+        try:
+            with open(fname, 'r', encoding='utf-8') as f:
+                data = {int(k): v for k, v in json.load(f).items()}
+            store.write({(tbl, k): json.dumps(v) for k, v in data.items()})
+            var.update(data)
+            os.replace(fname, f"{fname}.migrated")
+            logging.info(f"Migrated {len(data)} records from {fname}")
+        except Exception as e:
+            logging.error(f"Migration error for {fname}: {e}")
 
-def save_db():
-    files = [("subs.json", subs_db), ("p2p_subs.json", p2p_subs_db), ("memos.json", user_memos), ("p2p_usage.json", p2p_usage)]
-    for fname, var in files:
-        with open(fname, "w", encoding='utf-8') as f:
-            json.dump(var, f)
+def save_db(tbl: str, key):
+    store.put(tbl, key, DB_TABLES[tbl].get(key))
 
 def is_main_sub_active(user_id):
     return subs_db.get(user_id, 0) > datetime.now(timezone.utc).timestamp()
@@ -109,80 +700,437 @@ def is_main_sub_active(user_id):
 def is_p2p_active(user_id):
     return is_main_sub_active(user_id) or p2p_subs_db.get(user_id, 0) > datetime.now(timezone.utc).timestamp()
 
+def is_trial(user_id):
+    return user_id in trials and trials[user_id] == subs_db.get(user_id)
+
 def can_create_p2p_offer(user_id):
     return is_p2p_active(user_id) or p2p_usage.get(user_id, 0) < 3
 
 def generate_memo(user_id):
-    import random
     return f"WA{user_id}{random.randint(100000, 999999)}"
 
 async def send_waiting(chat_id, bot):
     return await bot.send_message(chat_id, "⏳ Расчёт курса...")
 
-async def _get_fiat_rate(from_curr: str, to_curr: str) -> float:
-    if from_curr == to_curr:
-        return 1.0
-    try:
-        url = f"https://api.exchangerate-api.com/v4/latest/{from_curr}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=5) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return data["rates"].get(to_curr, 1.0)
-    except:
-        return 1.0
-
-async def _get_crypto_rate(asset: str) -> float:
-    asset_map = {
-        "BTC": "bitcoin", "ETH": "ethereum", "TON": "the-open-network",
-        "SOL": "solana", "DOGE": "dogecoin", "XRP": "ripple",
-        "USDT": "tether", "USDC": "usd-coin", "MNT": "mantle", "TRX": "tron"
-    }
-    asset_id = asset_map.get(asset.upper(), "bitcoin")
-    try:
-        url = f"https://api.coingecko.com/api/v3/simple/price?ids={asset_id}&vs_currencies=usd"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=5) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return data.get(asset_id, {}).get("usd", 1.0)
-    except:
-        return 1.0
-
-async def get_exchange_rate(from_asset: str, to_asset: str) -> float:
-    if from_asset == "STARS":
-        if to_asset == "RUB":
-            return STARS_TO_RUB
-        elif to_asset == "USD":
-            return STARS_TO_USD
-        else:
-            usd_fiat = await _get_fiat_rate("USD", to_asset)
-            return STARS_TO_USD * usd_fiat
-    if to_asset == "STARS":
-        if from_asset == "RUB":
-            return 1 / STARS_TO_RUB
-        elif from_asset == "USD":
-            return 1 / STARS_TO_USD
-        else:
-            fiat_usd = await _get_fiat_rate(from_asset, "USD")
-            return fiat_usd / STARS_TO_USD
-    if from_asset in FIAT_CURRENCIES and to_asset in FIAT_CURRENCIES:
-        return await _get_fiat_rate(from_asset, to_asset)
-    if from_asset in CRYPTO_ASSETS and to_asset in FIAT_CURRENCIES:
-        crypto_usd = await _get_crypto_rate(from_asset)
-        if to_asset == "USD":
-            return crypto_usd
-        usd_fiat = await _get_fiat_rate("USD", to_asset)
-        return crypto_usd * usd_fiat
-    if from_asset in FIAT_CURRENCIES and to_asset in CRYPTO_ASSETS:
-        fiat_usd = 1 / await _get_fiat_rate(from_asset, "USD") if from_asset != "USD" else 1.0
-        crypto_usd = await _get_crypto_rate(to_asset)
-        return fiat_usd / crypto_usd if crypto_usd else 0.0
-    if from_asset in CRYPTO_ASSETS and to_asset in CRYPTO_ASSETS:
-        from_usd = await _get_crypto_rate(from_asset)
-        to_usd = await _get_crypto_rate(to_asset)
-        return from_usd / to_usd if to_usd else 1.0
-    return 1.0
+SUB_MESSAGES = {
+    ("main", "remind"): "⏳ Подписка Whale Alert скоро закончится.",
+    ("main", "expire"): "⌛ Подписка Whale Alert закончилась.",
+    ("p2p", "remind"): "⏳ P2P-подписка скоро закончится.",
+    ("p2p", "expire"): "⌛ P2P-подписка закончилась.",
+}
+
+# Индекс окончаний подписок: min-куча (момент, user_id, вид, событие, срок),
+# одна задача спит до ближайшего события; активные подписчики — множества в памяти
+class SubscriptionScheduler:
+    def __init__(self, remind_before: float):
+        self.remind_before = remind_before
+        self.active = {"main": set(), "p2p": set()}
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @staticmethod
+    def _expires(kind: str, user_id: int) -> float:
+        return (subs_db if kind == "main" else p2p_subs_db).get(user_id, 0)
+
+    def _entries(self, kind: str, user_id: int, now: float) -> list:
+        expires = self._expires(kind, user_id)
+        if expires <= now:
+            self.active[kind].discard(user_id)
+            return []
+        self.active[kind].add(user_id)
+        entries = [(expires, user_id, kind, "expire", expires)]
+        if expires - self.remind_before > now:
+            entries.append((expires - self.remind_before, user_id, kind, "remind", expires))
+        return entries
+
+    def load(self):
+        now = time.time()
+        self._heap = [e for uid in subs_db for e in self._entries("main", uid, now)]
+        self._heap += [e for uid in p2p_subs_db for e in self._entries("p2p", uid, now)]
+        heapq.heapify(self._heap)
+
+    def track(self, user_id: int, kind: str = "main"):
+        # вызывается после любого изменения срока; старые записи кучи отбрасываются при извлечении.
+        # Куча нужна только там, где работает планировщик, — на остальных воркерах не растёт
+        if self._task is None:
+            return
+        for entry in self._entries(kind, user_id, time.time()):
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._wakeup.set()
+        self._publish()
+
+    def start(self):
+        self.load()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def pop_due(self, now: float) -> list:
+        events = []
+        while self._heap and self._heap[0][0] <= now:
+            _, user_id, kind, event, expires = heapq.heappop(self._heap)
+            if self._expires(kind, user_id) != expires:
+                continue
+            if event == "expire":
+                self.active[kind].discard(user_id)
+            events.append((user_id, kind, event))
+        return events
+
+    def _publish(self):
+        # число активных подписок знает только планировщик воркера 0 — /stats берёт его из stats
+        for kind, users in self.active.items():
+            analytics.set(f"subs_active:{kind}", len(users))
+
+    async def _run(self):
+        while True:
+            self._notify(self.pop_due(time.time()))
+            self._publish()
+            self._wakeup.clear()
+            timeout = max(self._heap[0][0] - time.time(), 0) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _notify(self, events: list):
+        groups = {}
+        for user_id, kind, event in events:
+            if user_id in blocked_users:
+                continue
+            # после окончания основной подписки P2P может ещё действовать — тогда молчим
+            if kind == "main" and event == "expire" and user_id in self.active["p2p"]:
+                continue
+            groups.setdefault((kind, event), []).append(user_id)
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("💎 Продлить", callback_data=router.data("pay"))]])
+        for key, user_ids in groups.items():
+            broadcaster.broadcast(SUB_MESSAGES[key], user_ids, reply_markup=kb)
+
+subscriptions = SubscriptionScheduler(SUB_REMIND_BEFORE)
+
+# Общий пул соединений для всех внешних API: keep-alive, лимиты на хост,
+# кэш DNS и повторы с экспоненциальной задержкой
+class HttpClient:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, limit: int, per_host: int, timeout: float, retries: int):
+        self.limit = limit
+        self.per_host = per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, 3))
+        self.retries = retries
+        self._session = None
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.per_host,
+                ttl_dns_cache=300, enable_cleanup_closed=True
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get_json(self, url: str, params: dict = None, headers: dict = None):
+        host = urlsplit(url).hostname
+        try:
+            with metrics.timer("bot_upstream_seconds", host=host):
+                return await self._get_json(url, params, headers, host)
+        except Exception:
+            metrics.inc("bot_upstream_errors_total", host=host)
+            raise
+
+    async def _get_json(self, url: str, params: dict, headers: dict, host: str):
+        await self.start()
+        delay = 0.5
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._session.get(url, params=params, headers=headers) as resp:
+                    if resp.status in self.RETRY_STATUSES and attempt < self.retries:
+                        retry_after = resp.headers.get("Retry-After", "")
+                        wait = float(retry_after) if retry_after.isdigit() else delay
+                    else:
+                        resp.raise_for_status()
+                        return await resp.json()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.retries:
+                    raise
+                wait = delay
+            metrics.inc("bot_upstream_retries_total", host=host)
+            await asyncio.sleep(wait * (1 + random.random() / 2))
+            delay *= 2
+
+http = HttpClient(HTTP_POOL_LIMIT, HTTP_PER_HOST_LIMIT, HTTP_TIMEOUT, HTTP_RETRIES)
+
+# Кэш с TTL: устаревшее значение отдаётся сразу и обновляется в фоне,
+# одновременные запросы одного ключа ждут один общий запрос к API
+class RateCache:
+    def __init__(self, ttl: float, stale: float):
+        self.ttl = ttl
+        self.stale = stale
+        self._data = {}
+        self._inflight = {}
+
+    async def get(self, key, loader):
+        entry = self._data.get(key)
+        if entry:
+            value, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                metrics.inc("bot_rate_cache_total", key=key, result="hit")
+                return value
+            if age < self.ttl + self.stale:
+                metrics.inc("bot_rate_cache_total", key=key, result="stale")
+                self.refresh(key, loader)
+                return value
+        metrics.inc("bot_rate_cache_total", key=key, result="miss")
+        try:
+            return await asyncio.shield(self.refresh(key, loader))
+        except Exception:
+            if entry:
+                return entry[0]
+            raise
+
+    def peek(self, key):
+        entry = self._data.get(key)
+        return entry[0] if entry else None
+
+    def fetched_at(self, key):
+        entry = self._data.get(key)
+        return entry[1] if entry else None
+
+    def refresh(self, key, loader):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, loader))
+            task.add_done_callback(self._log_failure)
+            self._inflight[key] = task
+        return task
+
+    async def _load(self, key, loader):
+        try:
+            value = await loader()
+            self._data[key] = (value, time.monotonic())
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception():
+            logging.warning(f"Rate refresh failed: {task.exception()!r}")
+
+rate_cache = RateCache(RATE_CACHE_TTL, RATE_CACHE_STALE)
+
+async def _fetch_fiat_rates() -> dict:
+    data = await http.get_json(FIAT_API_URL)
+    return data["rates"]
+
+async def _fetch_crypto_prices() -> dict:
+    # один запрос simple/price на все активы сразу
+    params = {"ids": ",".join(COINGECKO_IDS.values()), "vs_currencies": "usd"}
+    data = await http.get_json(COINGECKO_API_URL, params)
+    return {asset: data[cid]["usd"] for asset, cid in COINGECKO_IDS.items() if cid in data}
+
+# Матрица кросс-курсов N×N по USD-ценам всех активов, включая STARS:
+# matrix[i, j] — сколько единиц актива j дают за 1 единицу актива i
+class RateMatrix:
+    def __init__(self, assets: list):
+        self.assets = assets
+        self.index = {a: i for i, a in enumerate(assets)}
+        self.usd = np.full(len(assets), np.nan)
+        self.matrix = None
+        self.updated_at = None
+
+    def build(self, fiat_rates: dict, crypto_prices: dict, updated_at: float = None):
+        usd = np.full(len(self.assets), np.nan)
+        fiat_idx = [self.index[a] for a in FIAT_CURRENCIES]
+        per_usd = np.array([fiat_rates.get(a) or np.nan for a in FIAT_CURRENCIES], dtype=float)
+        usd[fiat_idx] = 1 / per_usd
+        crypto_idx = [self.index[a] for a in CRYPTO_ASSETS]
+        usd[crypto_idx] = [crypto_prices.get(a) or np.nan for a in CRYPTO_ASSETS]
+        stars, rub = self.index["STARS"], self.index["RUB"]
+        usd[stars] = STARS_TO_USD
+        matrix = usd[:, None] / usd[None, :]
+        matrix[stars, rub] = STARS_TO_RUB
+        matrix[rub, stars] = 1 / STARS_TO_RUB
+        self.usd, self.matrix = usd, matrix
+        # updated_at — когда пришли сами данные, а не когда пересобрали матрицу:
+        # при недоступных API матрица строится из старого кэша и возраст курса растёт
+        if updated_at is None or updated_at != self.updated_at:
+            price_history.record(time.time(), usd[[self.index[a] for a in price_history.assets]])
+        self.updated_at = time.monotonic() if updated_at is None else updated_at
+
+    def age(self) -> float:
+        return time.monotonic() - self.updated_at if self.updated_at is not None else float("inf")
+
+    def is_fresh(self) -> bool:
+        return self.age() <= RATE_MAX_AGE
+
+    def quote(self, from_asset: str, to_asset: str):
+        i, j = self.index.get(from_asset), self.index.get(to_asset)
+        if self.matrix is None or i is None or j is None:
+            return None
+        rate = self.matrix[i, j]
+        if np.isnan(rate):
+            return None
+        return float(rate), self.age()
+
+    async def refresh(self, force: bool = False):
+        fetch = rate_cache.refresh if force else rate_cache.get
+        fiat, crypto = await asyncio.gather(
+            fetch("fiat", _fetch_fiat_rates), fetch("crypto", _fetch_crypto_prices),
+            return_exceptions=True
+        )
+        if isinstance(fiat, Exception):
+            fiat = rate_cache.peek("fiat") or {}
+        if isinstance(crypto, Exception):
+            crypto = rate_cache.peek("crypto") or {}
+        fetched = [rate_cache.fetched_at("fiat"), rate_cache.fetched_at("crypto")]
+        self.build(fiat, crypto, min(fetched) if None not in fetched else float("-inf"))
+
+rate_matrix = RateMatrix(ALL_ASSETS + ["STARS"])
+
+async def rate_refresher():
+    while True:
+        try:
+            await rate_matrix.refresh(force=True)
+        except Exception as e:
+            logging.error(f"Rate refresh error: {e}")
+        await asyncio.sleep(RATE_REFRESH_INTERVAL)
+
+async def get_quote(from_asset: str, to_asset: str):
+    # (курс, возраст в сек.) или None, если курса по паре нет
+    quote = rate_matrix.quote(from_asset, to_asset)
+    if quote is None or quote[1] > RATE_MAX_AGE:
+        await rate_matrix.refresh()
+        quote = rate_matrix.quote(from_asset, to_asset)
+    return quote
+
+async def get_exchange_rate(from_asset: str, to_asset: str):
+    quote = await get_quote(from_asset, to_asset)
+    return quote[0] if quote else None
+
+# Кольцевые буферы USD-цен по всем активам: корзины 1m/1h/1d фиксированной длины.
+# Корзина b лежит в слоте b % slots, epochs[slot] == b отличает живую корзину от затёртой,
+# поэтому запись и чтение любой корзины — O(1), а память не растёт со временем.
+# values[slot] = (последняя цена, сумма, число замеров) по каждому активу
+class PriceHistory:
+    RESOLUTIONS = {"1m": 60, "1h": 3600, "1d": 86400}
+
+    def __init__(self, assets: list, slots: dict, path: str = ""):
+        self.assets = assets
+        self.index = {a: i for i, a in enumerate(assets)}
+        self.slots = slots
+        self.path = path
+        self.values = {res: self._empty_values(n) for res, n in slots.items()}
+        self.epochs = {res: np.full(n, -1, dtype=np.int64) for res, n in slots.items()}
+
+    def _empty_values(self, n: int):
+        values = np.zeros((n, 3, len(self.assets)))
+        values[:, 0] = np.nan
+        return values
+
+    def open(self):
+        # буферы в файлах .npy через memmap: переживают перезапуск, пишет ОС
+        if not self.path:
+            return
+        meta = f"{self.path}.json"
+        same = False
+        if os.path.exists(meta):
+            with open(meta, encoding="utf-8") as f:
+                same = json.load(f) == {"assets": self.assets, "slots": self.slots}
+        for res, n in self.slots.items():
+            vpath, epath = f"{self.path}_{res}.npy", f"{self.path}_{res}_epochs.npy"
+            if same and os.path.exists(vpath) and os.path.exists(epath):
+                self.values[res] = np.lib.format.open_memmap(vpath, mode="r+")
+                self.epochs[res] = np.lib.format.open_memmap(epath, mode="r+")
+                continue
+            values = np.lib.format.open_memmap(vpath, mode="w+", dtype=np.float64, shape=(n, 3, len(self.assets)))
+            values[:] = self.values[res]
+            epochs = np.lib.format.open_memmap(epath, mode="w+", dtype=np.int64, shape=(n,))
+            epochs[:] = self.epochs[res]
+            self.values[res], self.epochs[res] = values, epochs
+        with open(meta, "w", encoding="utf-8") as f:
+            json.dump({"assets": self.assets, "slots": self.slots}, f)
+
+    def flush(self):
+        for arr in (*self.values.values(), *self.epochs.values()):
+            if isinstance(arr, np.memmap):
+                arr.flush()
+
+    def record(self, t: float, usd):
+        # usd — цены в порядке self.assets, NaN — нет данных
+        usd = np.asarray(usd, dtype=float)
+        seen = ~np.isnan(usd)
+        for res, step in self.RESOLUTIONS.items():
+            values, epochs = self.values[res], self.epochs[res]
+            bucket = int(t // step)
+            slot = bucket % len(epochs)
+            row = values[slot]
+            if epochs[slot] != bucket:
+                row[0] = np.nan
+                row[1:] = 0
+                epochs[slot] = bucket
+            row[0, seen] = usd[seen]
+            row[1, seen] += usd[seen]
+            row[2, seen] += 1
+
+    def series(self, asset: str, res: str, count: int, now: float = None, vs: str = "USD"):
+        # средние цены asset в vs за последние count корзин, старые -> новые; NaN — нет данных
+        i, j = self.index.get(asset), self.index.get(vs)
+        if i is None or j is None:
+            return None
+        count = min(count, len(self.epochs[res]))
+        last = int((now or time.time()) // self.RESOLUTIONS[res])
+        buckets = np.arange(last - count + 1, last + 1)
+        slots = buckets % len(self.epochs[res])
+        rows = self.values[res][slots]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avg = rows[:, 1] / rows[:, 2]
+        avg[self.epochs[res][slots] != buckets] = np.nan
+        return avg[:, i] / avg[:, j]
+
+    def change(self, asset: str, window: float, now: float = None, vs: str = "USD"):
+        # изменение цены за window секунд в долях; берётся самое мелкое разрешение, где окно помещается
+        for res, step in self.RESOLUTIONS.items():
+            if window / step < len(self.epochs[res]) - 1:
+                break
+        series = self.series(asset, res, int(window // step) + 1, now, vs)
+        if series is None:
+            return None
+        valid = series[~np.isnan(series)]
+        if len(valid) < 2 or not valid[0]:
+            return None
+        return float(valid[-1] / valid[0] - 1)
+
+price_history = PriceHistory(
+    ALL_ASSETS, {"1m": HISTORY_MINUTES, "1h": HISTORY_HOURS, "1d": HISTORY_DAYS},
+    f"{HISTORY_PATH}_{WORKER_ID}" if HISTORY_PATH and WORKER_ID else HISTORY_PATH
+)
+
+SPARK_BARS = "▁▂▃▄▅▆▇█"
+
+def sparkline(values, width: int = 48) -> str:
+    values = np.asarray(values, dtype=float)
+    if len(values) > width:
+        # ужимаем до width точек средними по кускам
+        chunks = np.array_split(values, width)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            values = np.array([np.nanmean(c) for c in chunks])
+    valid = values[~np.isnan(values)]
+    if not len(valid):
+        return ""
+    lo, hi = valid.min(), valid.max()
+    scale = (len(SPARK_BARS) - 1) / (hi - lo) if hi > lo else 0
+    return "".join(" " if np.isnan(v) else SPARK_BARS[int(round((v - lo) * scale))] for v in values)
 
 def get_min_amount(asset: str) -> str:
     if asset == "RUB":
@@ -208,27 +1156,1064 @@ def calculate_receive_amount(give: str, give_amt: float, receive: str) -> (float
     else:
         return give_amt, 0
 
-def get_similar_offers(give: str, receive: str):
-    offers = []
-    for uid, orders in exchange_orders.items():
-        for o in orders[-5:]:
-            if o["from_coin"] == give and o["to_coin"] == receive:
-                offers.append({
-                    "give_amt": o["amount"],
-                    "give": o["from_coin"],
-                    "receive_amt": o["final_amount"],
-                    "receive": o["to_coin"],
-                    "contact": o["contact"]
+class Order(NamedTuple):
+    seq: int
+    user_id: int
+    id: int
+    from_coin: str
+    to_coin: str
+    amount: float
+    final_amount: float
+    fee: float
+    contact: str
+    timestamp: float
+
+# Книга заявок по парам (from_coin, to_coin): курсы и номера заявок лежат
+# в параллельных массивах, отсортированных по курсу; поиск — бинарный
+class OrderBook:
+    def __init__(self):
+        self.books = {}
+
+    def __len__(self):
+        return sum(len(rates) for rates, _ in self.books.values())
+
+    def add(self, pair: tuple, rate: float, seq: int):
+        rates, seqs = self.books.setdefault(pair, (array("d"), array("q")))
+        i = bisect_right(rates, rate)
+        rates.insert(i, rate)
+        seqs.insert(i, seq)
+
+    def remove(self, pair: tuple, rate: float, seq: int):
+        book = self.books.get(pair)
+        if not book:
+            return
+        rates, seqs = book
+        # при равных курсах номера идут по возрастанию (add вставляет справа) — ищем и их бисекцией
+        lo, hi = bisect_left(rates, rate), bisect_right(rates, rate)
+        i = bisect_left(seqs, seq, lo, hi)
+        if i < hi and seqs[i] == seq:
+            del rates[i]
+            del seqs[i]
+        if not rates:
+            del self.books[pair]
+
+    def nearest(self, pair: tuple, rate: float, k: int) -> list:
+        rates, seqs = self.books.get(pair, ((), ()))
+        hi = bisect_left(rates, rate)
+        lo = hi - 1
+        picked = []
+        while len(picked) < k and (lo >= 0 or hi < len(rates)):
+            if hi >= len(rates) or (lo >= 0 and rate - rates[lo] <= rates[hi] - rate):
+                picked.append(seqs[lo])
+                lo -= 1
+            else:
+                picked.append(seqs[hi])
+                hi += 1
+        return picked
+
+    def best(self, pair: tuple, k: int) -> list:
+        _, seqs = self.books.get(pair, ((), ()))
+        return list(reversed(seqs[-k:]))
+
+# Колоночное хранилище заявок: кольцевой буфер на ORDERS_MAX строк,
+# монеты и контакты хранятся индексами (слоты контактов переиспользуются),
+# у пользователя — не больше ORDERS_PER_USER
+class OrderStore:
+    def __init__(self, capacity: int, per_user: int, ttl: float):
+        self.capacity = capacity
+        self.per_user = per_user
+        self.ttl = ttl
+        self.coins, self._coin_idx = [], {}
+        self.contacts, self._contact_idx = [], {}
+        self.contact_refs = array("I")
+        self._free_contacts = []
+        self.user = array("q")
+        self.oid = array("I")
+        self.frm = array("B")
+        self.to = array("B")
+        self.amount = array("d")
+        self.final = array("d")
+        self.fee = array("d")
+        self.ts = array("d")
+        self.contact = array("I")
+        self.key = array("q")
+        self.alive = bytearray()
+        self.by_user = {}
+        self.book = OrderBook()
+        self.next_seq = 0
+        self._last_key = 0
+        self._expire_seq = 0
+        self._dropped = []
+
+    def __len__(self):
+        return sum(len(seqs) for seqs in self.by_user.values())
+
+    def record_bytes(self) -> int:
+        columns = (self.user, self.oid, self.frm, self.to, self.amount, self.final, self.fee, self.ts, self.contact, self.key)
+        return sum(c.itemsize * len(c) for c in columns) + len(self.alive)
+
+    def _intern(self, value: str, values: list, index: dict) -> int:
+        i = index.get(value)
+        if i is None:
+            i = index[value] = len(values)
+            values.append(value)
+        return i
+
+    def _add_contact(self, contact: str) -> int:
+        # контакты со счётчиком ссылок: слот последней заявки контакта уходит в список свободных
+        i = self._contact_idx.get(contact)
+        if i is None:
+            if self._free_contacts:
+                i = self._free_contacts.pop()
+                self.contacts[i] = contact
+            else:
+                i = len(self.contacts)
+                self.contacts.append(contact)
+                self.contact_refs.append(0)
+            self._contact_idx[contact] = i
+        self.contact_refs[i] += 1
+        return i
+
+    def _release_contact(self, i: int):
+        self.contact_refs[i] -= 1
+        if not self.contact_refs[i]:
+            del self._contact_idx[self.contacts[i]]
+            self.contacts[i] = None
+            self._free_contacts.append(i)
+
+    def _rate(self, row: int) -> float:
+        return self.final[row] / self.amount[row] if self.amount[row] else 0.0
+
+    def _pair(self, row: int) -> tuple:
+        return self.coins[self.frm[row]], self.coins[self.to[row]]
+
+    def get(self, seq: int) -> Order:
+        row = seq % self.capacity
+        return Order(
+            seq, self.user[row], self.oid[row], *self._pair(row), self.amount[row],
+            self.final[row], self.fee[row], self.contacts[self.contact[row]], self.ts[row]
+        )
+
+    def user_orders(self, user_id: int) -> list:
+        return [self.get(seq) for seq in self.by_user.get(user_id, ())]
+
+    def _new_key(self) -> int:
+        # ключ записи на диске: микросекунды * 16 + номер воркера — уникален между процессами
+        key = time.time_ns() // 1000 * 16 + WORKER_ID % 16
+        if key <= self._last_key:
+            key = self._last_key + 16
+        self._last_key = key
+        return key
+
+    def add(self, user_id, oid, from_coin, to_coin, amount, final_amount, fee, contact, ts=None, key=None, persist=True) -> Order:
+        # NaN в книге ломает порядок для bisect — такие заявки не принимаются
+        if not all(map(math.isfinite, (amount, final_amount, fee))):
+            raise ValueError(f"Non-finite order amounts: {amount}, {final_amount}, {fee}")
+        seq = self.next_seq
+        row = seq % self.capacity
+        if seq >= self.capacity:
+            self._drop(seq - self.capacity, persist)
+        columns = (
+            (self.user, user_id), (self.oid, oid),
+            (self.frm, self._intern(sys.intern(from_coin), self.coins, self._coin_idx)),
+            (self.to, self._intern(sys.intern(to_coin), self.coins, self._coin_idx)),
+            (self.amount, amount), (self.final, final_amount), (self.fee, fee),
+            (self.contact, self._add_contact(contact)),
+            (self.ts, ts or time.time()), (self.key, key or self._new_key()), (self.alive, 1)
+        )
+        grow = row == len(self.alive)
+        for column, value in columns:
+            if grow:
+                column.append(value)
+            else:
+                column[row] = value
+        self.next_seq = seq + 1
+        self.by_user.setdefault(user_id, array("q")).append(seq)
+        if len(self.by_user[user_id]) > self.per_user:
+            self._drop(self.by_user[user_id][0], persist)
+        if self.ts[row] + self.ttl > time.time():
+            self.book.add(self._pair(row), self._rate(row), seq)
+        if persist:
+            store.put("orders", self.key[row], [user_id, oid, from_coin, to_coin, amount, final_amount, fee, contact, self.ts[row]])
+        return self.get(seq)
+
+    def _drop(self, seq: int, persist: bool):
+        row = seq % self.capacity
+        if not self.alive[row]:
+            return
+        self.alive[row] = 0
+        self.book.remove(self._pair(row), self._rate(row), seq)
+        self._release_contact(self.contact[row])
+        seqs = self.by_user[self.user[row]]
+        seqs.remove(seq)
+        if not seqs:
+            del self.by_user[self.user[row]]
+        if persist:
+            store.delete("orders", self.key[row])
+        else:
+            self._dropped.append(self.key[row])
+
+    def expire(self, now: float = None):
+        # заявки добавляются по времени, поэтому истекают строго по порядку номеров
+        now = now or time.time()
+        self._expire_seq = max(self._expire_seq, self.next_seq - self.capacity)
+        while self._expire_seq < self.next_seq:
+            row = self._expire_seq % self.capacity
+            if self.alive[row] and self.ts[row] + self.ttl > now:
+                break
+            if self.alive[row]:
+                self.book.remove(self._pair(row), self._rate(row), self._expire_seq)
+            self._expire_seq += 1
+
+    def similar(self, give: str, receive: str, rate: float = None, k: int = 3) -> list:
+        self.expire()
+        if rate is None:
+            seqs = self.book.best((give, receive), k)
+        else:
+            seqs = self.book.nearest((give, receive), rate, k)
+        return [self.get(seq) for seq in seqs]
+
+    def load(self, rows: dict):
+        self._dropped = []
+        for key in sorted(rows):
+            try:
+                self.add(*rows[key], key=key, persist=False)
+            except ValueError as e:
+                logging.warning(f"Order {key} skipped: {e}")
+                self._dropped.append(key)
+                continue
+            if key % 16 == WORKER_ID % 16:
+                self._last_key = max(self._last_key, key)
+        self.expire()
+        if self._dropped:
+            store.write({("orders", key): None for key in self._dropped})
+            self._dropped = []
+
+    def merge(self, rows: dict):
+        # заявки, опубликованные другими воркерами (из журнала изменений)
+        for key in sorted(rows):
+            try:
+                self.add(*rows[key], key=key, persist=False)
+            except ValueError as e:
+                logging.warning(f"Order {key} skipped: {e}")
+        for key in self._dropped:
+            store.delete("orders", key)
+        self._dropped = []
+
+exchange_orders = OrderStore(ORDERS_MAX, ORDERS_PER_USER, ORDER_TTL)
+metrics.gauge("bot_orders", "Активных P2P-заявок в памяти", lambda: len(exchange_orders))
+
+def get_similar_offers(give: str, receive: str, rate: float = None, k: int = 3):
+    # с курсом — ближайшие к нему заявки, без курса — самые выгодные
+    return [{
+        "give_amt": o.amount,
+        "give": o.from_coin,
+        "receive_amt": o.final_amount,
+        "receive": o.to_coin,
+        "contact": o.contact
+    } for o in exchange_orders.similar(give, receive, rate, k)]
+
+# === QR ===
+def render_qr(url: str) -> bytes:
+    import qrcode
+    qr = qrcode.QRCode(box_size=5, border=2)
+    qr.add_data(url)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+# LRU готовых PNG по платёжному URI; рендер идёт в отдельном потоке
+class QrCache:
+    def __init__(self, size: int):
+        self.size = size
+        self._png = OrderedDict()
+
+    async def render(self, url: str) -> bytes:
+        png = self._png.get(url)
+        if png is not None:
+            metrics.inc("bot_qr_cache_total", result="png")
+            self._png.move_to_end(url)
+            return png
+        metrics.inc("bot_qr_cache_total", result="render")
+        png = await asyncio.to_thread(render_qr, url)
+        self._png[url] = png
+        if len(self._png) > self.size:
+            self._png.popitem(last=False)
+        return png
+
+qr_cache = QrCache(QR_CACHE_SIZE)
+
+# === СИГНАЛЫ ===
+def normalize_address(address) -> str:
+    address = str(address or "")
+    return address.lower() if address.startswith("0x") else address
+
+def load_exchange_addresses():
+    if not os.path.exists(EXCHANGE_ADDRESSES_FILE):
+        return
+    try:
+        with open(EXCHANGE_ADDRESSES_FILE, encoding="utf-8") as f:
+            EXCHANGE_ADDRESSES.update({normalize_address(a): name for a, name in json.load(f).items()})
+    except Exception as e:
+        logging.error(f"Exchange addresses error: {e}")
+
+# Источник транзакций из JSONL-файла (одна транзакция на строку):
+# {"chain": "eth", "hash": "0x..", "asset": "ETH", "amount": 1.5, "from": "0x..", "to": "0x..", "ts": 1700000000}
+# При follow=True файл дочитывается по мере дозаписи, как tail -f; смещение хранится
+# в whale_cursors, так что после перезапуска чтение продолжается с того же места
+class FileChainSource:
+    def __init__(self, path: str, batch_size: int = WHALE_BATCH_SIZE, follow: bool = True, poll: float = 1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.follow = follow
+        self.poll = poll
+
+    def __repr__(self):
+        return f"file:{self.path}"
+
+    async def batches(self):
+        key = repr(self)
+        offset = whale_cursors.get(key, 0)
+        while True:
+            lines, offset = await asyncio.to_thread(self._read, offset)
+            if lines:
+                yield self._decode(lines)
+                whale_cursors[key] = offset
+                save_db("whale_cursors", key)
+                continue
+            if not self.follow:
+                return
+            await asyncio.sleep(self.poll)
+
+    def _decode(self, lines: list) -> list:
+        # битая строка пропускается: иначе чтение упиралось бы в неё с того же смещения вечно
+        records = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                logging.warning(f"{self!r}: bad line skipped ({e}): {line[:200]!r}")
+                continue
+            if isinstance(record, dict):
+                records.append(record)
+        return records
+
+    def _read(self, offset: int):
+        if not os.path.exists(self.path):
+            return [], offset
+        with open(self.path, "rb") as f:
+            if offset > os.fstat(f.fileno()).st_size:
+                offset = 0  # файл пересоздан или обрезан
+            f.seek(offset)
+            lines = []
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                lines.append(line)
+                offset += len(line)
+                if len(lines) >= self.batch_size:
+                    break
+        return lines, offset
+
+# Источник транзакций из TCP-потока в том же формате JSONL
+# (индексатор ноды или локальная заглушка); переподключается при обрыве
+class SocketChainSource:
+    def __init__(self, host: str, port: int, reconnect: float = 5.0):
+        self.host = host
+        self.port = port
+        self.reconnect = reconnect
+
+    def __repr__(self):
+        return f"tcp:{self.host}:{self.port}"
+
+    async def batches(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                logging.warning(f"{self!r} connect failed: {e}")
+                await asyncio.sleep(self.reconnect)
+                continue
+            tail = b""
+            try:
+                while chunk := await reader.read(1 << 16):
+                    *lines, tail = (tail + chunk).split(b"\n")
+                    batch = [json.loads(line) for line in lines if line.strip()]
+                    if batch:
+                        yield batch
+            finally:
+                writer.close()
+            await asyncio.sleep(self.reconnect)
+
+def parse_sources(spec: str) -> list:
+    sources = []
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        kind, _, target = item.partition(":")
+        if kind == "file":
+            sources.append(FileChainSource(target))
+        elif kind == "tcp":
+            host, _, port = target.rpartition(":")
+            sources.append(SocketChainSource(host, int(port)))
+        else:
+            logging.error(f"Unknown whale source: {item}")
+    return sources
+
+# Конвейер: источники -> ограниченная очередь пачек -> дедупликация ->
+# пересчёт в USD и фильтры по порогу/биржевым адресам сразу для всей пачки
+class WhalePipeline:
+    def __init__(self, sources: list, on_signal, threshold: float, exchange_min: float, dedup_size: int, queue_size: int, max_age: float):
+        self.sources = sources
+        self.on_signal = on_signal
+        self.threshold = threshold
+        self.exchange_min = exchange_min
+        self.dedup_size = dedup_size
+        self.max_age = max_age
+        self.queue = asyncio.Queue(queue_size)
+        self.processed = 0
+        self.signals = 0
+        self._seen = set()
+        self._seen_order = deque()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._consume(src)) for src in self.sources]
+        self._tasks.append(asyncio.create_task(self._run()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _consume(self, source):
+        while True:
+            try:
+                async for batch in source.batches():
+                    await self.queue.put(batch)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Whale source {source!r} error: {e}")
+                await asyncio.sleep(5)
+
+    async def _run(self):
+        while True:
+            batch = await self.queue.get()
+            try:
+                signals = self.process(batch)
+            except Exception as e:
+                logging.error(f"Whale batch error: {e}")
+                continue
+            for signal in signals:
+                try:
+                    await self.on_signal(signal)
+                except Exception as e:
+                    logging.error(f"Whale signal delivery error: {e}")
+
+    def dedupe(self, batch: list) -> list:
+        fresh = []
+        for tx in batch:
+            key = hash((tx.get("chain"), tx.get("hash")))
+            if key in self._seen:
+                continue
+            self._seen.add(key)
+            self._seen_order.append(key)
+            fresh.append(tx)
+        while len(self._seen_order) > self.dedup_size:
+            self._seen.discard(self._seen_order.popleft())
+        return fresh
+
+    def process(self, batch: list) -> list:
+        # транзакции без ts считаем свежими
+        cutoff = time.time() - self.max_age
+        txs = self.dedupe([tx for tx in batch if (tx.get("ts") or cutoff) >= cutoff])
+        self.processed += len(batch)
+        n = len(txs)
+        if not n:
+            return []
+        # последний элемент — NaN для неизвестных активов
+        prices = np.append(rate_matrix.usd, np.nan)
+        index = rate_matrix.index
+        idx = np.fromiter((index.get(str(tx.get("asset", "")).upper(), -1) for tx in txs), dtype=np.intp, count=n)
+        amounts = np.fromiter((float(tx.get("amount") or 0) for tx in txs), dtype=float, count=n)
+        exchanges = [EXCHANGE_ADDRESSES.get(normalize_address(tx.get("to"))) for tx in txs]
+        usd = amounts * prices[idx]
+        to_exchange = np.fromiter((e is not None for e in exchanges), dtype=bool, count=n)
+        mask = (usd >= self.threshold) | (to_exchange & (usd >= self.exchange_min))
+        signals = []
+        for i in np.flatnonzero(mask):
+            tx = txs[i]
+            signals.append({
+                "chain": tx.get("chain"),
+                "hash": tx.get("hash"),
+                "asset": str(tx.get("asset", "")).upper(),
+                "amount": float(amounts[i]),
+                "usd": float(usd[i]),
+                "from": tx.get("from"),
+                "to": tx.get("to"),
+                "exchange": exchanges[i],
+                "ts": tx.get("ts") or time.time()
+            })
+        self.signals += len(signals)
+        return signals
+
+def _short(address) -> str:
+    address = str(address or "?")
+    return f"{address[:6]}…{address[-4:]}" if len(address) > 12 else address
+
+def format_signal(signal: dict) -> str:
+    # всё, что пришло из источника транзакций, экранируется: сообщение уходит с parse_mode=HTML
+    chain = html.escape(NETWORK_NAMES.get(signal["chain"], str(signal["chain"]).upper()))
+    asset, exchange = html.escape(str(signal["asset"])), html.escape(str(signal["exchange"] or ""))
+    target = f"🏦 {exchange}" if exchange else html.escape(_short(signal["to"]))
+    msg = f"🐋 <b>{signal['amount']:,.2f} {asset}</b> (${signal['usd']:,.0f})\n"
+    if exchange:
+        msg += f"⚠️ Вход на биржу {exchange}\n"
+    msg += f"🌐 {chain}\n{html.escape(_short(signal['from']))} → {target}\n"
+    change = price_history.change(signal["asset"], 86400)
+    if change is not None:
+        msg += f"📊 {asset} за 24ч: {change:+.2%}\n"
+    msg += f"🔗 <code>{html.escape(str(signal['hash']))}</code>"
+    return msg
+
+def alert_recipients() -> list:
+    return [uid for uid in subscriptions.active["main"] if uid not in blocked_users]
+
+async def broadcast_signal(signal: dict):
+    broadcaster.broadcast(format_signal(signal), alert_recipients(), parse_mode="HTML")
+
+# === ОПЛАТЫ ===
+def plan_terms(kind: str, plan_id: str):
+    # (дней, ⭐) по типу подписки и id тарифа из callback_data
+    if kind == "main":
+        return next(((d, st) for d, st in MAIN_PLANS if str(d) == plan_id), None)
+    return next(((int(pid[:-1]), st) for pid, st, _ in P2P_PLANS if pid == plan_id), None)
+
+async def plan_price(stars: int, asset: str):
+    # цена тарифа в активе по матрице курсов; None, если курса нет — тогда счёт не выставляем
+    quote = rate_matrix.quote("RUB", asset)
+    if quote is None or quote[1] > RATE_MAX_AGE:
+        await rate_matrix.refresh()
+        quote = rate_matrix.quote("RUB", asset)
+    if quote is None:
+        return None
+    return float(f"{stars * STARS_TO_RUB * quote[0]:.4g}")
+
+def open_invoice(user_id: int, memo: str, kind: str, plan_id: str, asset: str, amount: float) -> dict:
+    days, _ = plan_terms(kind, plan_id)
+    now = time.time()
+    inv = invoices.get(memo)
+    if inv and (inv["kind"], inv["plan"], inv["asset"]) == (kind, plan_id, asset):
+        # повторный выбор того же счёта: сумма и уже полученные переводы сохраняются
+        inv["expires"] = now + INVOICE_TTL
+        save_db("invoices", memo)
+        return inv
+    inv = invoices[memo] = {
+        "user_id": user_id, "kind": kind, "plan": plan_id, "days": days,
+        "asset": asset, "chain": ASSET_TO_CHAIN.get(asset, "ton"), "amount": amount, "paid": 0.0, "txs": [],
+        "created": now, "expires": now + INVOICE_TTL
+    }
+    save_db("invoices", memo)
+    return inv
+
+# Платежи из JSONL-файла, формат как у FileChainSource, плюс memo:
+# {"chain": "ton", "hash": "..", "asset": "TON", "amount": 1.5, "to": "UQ..", "memo": "WA..", "ts": 1700000000}
+# Курсор — смещение в файле; годится как локальная заглушка и для выгрузок индексатора
+class FilePaymentSource(FileChainSource):
+    def covers(self, asset: str) -> bool:
+        return True
+
+    async def fetch(self, cursor):
+        offset = cursor or 0
+        transfers = []
+        while True:
+            lines, offset = await asyncio.to_thread(self._read, offset)
+            if not lines:
+                return transfers, offset
+            transfers += self._decode(lines)
+
+# Входящие переводы TON на платёжный адрес через toncenter API v3: один запрос за цикл
+# на все счета сразу (постранично, только если переводов больше limit). Курсор — lt транзакции
+class TonCenterSource:
+    def __init__(self, address: str, url: str = TONCENTER_API_URL, api_key: str = TONCENTER_API_KEY, limit: int = 256):
+        self.address = address
+        self.url = url.rstrip("/")
+        self.headers = {"X-API-Key": api_key} if api_key else None
+        self.limit = limit
+
+    def __repr__(self):
+        return f"toncenter:{self.address}"
+
+    def covers(self, asset: str) -> bool:
+        # только нативные TON: переводы жетонов этот источник не разбирает
+        return asset == "TON"
+
+    async def fetch(self, cursor):
+        params = {"account": self.address, "limit": self.limit}
+        if cursor is None:
+            # первый запуск: старые переводы не разбираем, начинаем с последней транзакции
+            data = await http.get_json(f"{self.url}/transactions", {**params, "limit": 1, "sort": "desc"}, self.headers)
+            txs = data.get("transactions", [])
+            return [], int(txs[0]["lt"]) if txs else 0
+        transfers = []
+        while True:
+            data = await http.get_json(f"{self.url}/transactions", {**params, "start_lt": cursor + 1, "sort": "asc"}, self.headers)
+            txs = data.get("transactions", [])
+            for tx in txs:
+                cursor = max(cursor, int(tx["lt"]))
+                msg = tx.get("in_msg") or {}
+                if not msg.get("source") or not msg.get("value"):
+                    continue
+                decoded = (msg.get("message_content") or {}).get("decoded") or {}
+                transfers.append({
+                    "chain": "ton", "hash": tx.get("hash"), "asset": "TON",
+                    "amount": int(msg["value"]) / 1e9, "to": self.address,
+                    "memo": decoded.get("comment", ""), "ts": tx.get("now", 0)
                 })
-    return offers[:3]
+            if len(txs) < self.limit:
+                return transfers, cursor
+
+def parse_payment_sources(spec: str) -> list:
+    sources = []
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        kind, _, target = item.partition(":")
+        if kind == "file":
+            sources.append(FilePaymentSource(target))
+        elif kind == "toncenter":
+            sources.append(TonCenterSource(target or PAYMENT_ADDRESSES["ton"]))
+        else:
+            logging.error(f"Unknown payment source: {item}")
+    return sources
+
+# Сверка платежей: каждый цикл — по одному запросу к каждому источнику от сохранённого курсора,
+# memo перевода ищется в словаре invoices за O(1). Оплаченный счёт удаляется вместе
+# с продлением подписки, поэтому повторно прочитанный перевод второй раз не засчитается
+class PaymentReconciler:
+    def __init__(self, sources: list, interval: float, tolerance: float):
+        self.sources = sources
+        self.interval = interval
+        self.tolerance = tolerance
+        self._task = None
+
+    def covers(self, asset: str) -> bool:
+        return any(source.covers(asset) for source in self.sources)
+
+    def start(self):
+        if self.sources:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                logging.error(f"Payment poll error: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def poll(self):
+        now = time.time()
+        for memo in [m for m, inv in invoices.items() if inv["expires"] < now]:
+            del invoices[memo]
+            save_db("invoices", memo)
+        for source in self.sources:
+            key = repr(source)
+            try:
+                transfers, cursor = await source.fetch(payment_cursors.get(key))
+            except Exception as e:
+                logging.warning(f"{key} fetch failed: {e}")
+                continue
+            for transfer in transfers:
+                # одна битая запись не должна останавливать курсор и остальные платежи
+                try:
+                    self.match(transfer)
+                except Exception as e:
+                    metrics.inc("bot_payments_total", result="invalid")
+                    logging.error(f"Payment record skipped ({e!r}): {transfer}")
+            if cursor != payment_cursors.get(key):
+                payment_cursors[key] = cursor
+                save_db("payment_cursors", key)
+
+    def match(self, transfer: dict):
+        memo = str(transfer.get("memo") or "").strip()
+        inv = invoices.get(memo)
+        if inv is None:
+            if memo.startswith("WA"):
+                metrics.inc("bot_payments_total", result="unmatched")
+                logging.warning(f"Payment without open invoice: {transfer}")
+            return
+        chain = transfer.get("chain")
+        if (chain != inv["chain"] or transfer.get("asset") != inv["asset"]
+                or normalize_address(transfer.get("to")) != normalize_address(PAYMENT_ADDRESSES.get(chain))
+                or transfer.get("ts", 0) < inv["created"] - 60):
+            metrics.inc("bot_payments_total", result="mismatch")
+            logging.warning(f"Payment does not match invoice {memo}: {transfer}")
+            return
+        # без хэша перевод нельзя отличить от повторно прочитанного — такие не засчитываем
+        tx = transfer.get("hash")
+        amount = float(transfer.get("amount") or 0)
+        if not tx or not math.isfinite(amount) or amount <= 0:
+            metrics.inc("bot_payments_total", result="invalid")
+            logging.warning(f"Invalid payment record for {memo}: {transfer}")
+            return
+        if tx in inv["txs"]:
+            return
+        inv["paid"] += amount
+        inv["txs"].append(tx)
+        if inv["paid"] < inv["amount"] * (1 - self.tolerance):
+            metrics.inc("bot_payments_total", result="partial")
+            save_db("invoices", memo)
+            return
+        self.credit(memo, inv)
+
+    def credit(self, memo: str, inv: dict):
+        user_id, kind = inv["user_id"], inv["kind"]
+        tbl, db = ("subs", subs_db) if kind == "main" else ("p2p_subs", p2p_subs_db)
+        db[user_id] = max(db.get(user_id, 0), time.time()) + inv["days"] * 86400
+        save_db(tbl, user_id)
+        del invoices[memo]
+        save_db("invoices", memo)
+        subscriptions.track(user_id, kind)
+        metrics.inc("bot_payments_total", result="credited")
+        analytics.inc("payments")
+        analytics.inc(f"payments:{kind}")
+        analytics.inc("revenue_usd", analytics.usd(inv["asset"], inv["paid"]))
+        if trials.pop(user_id, None) is not None:
+            # первая оплата после пробного дня; запись о пробном больше не нужна
+            save_db("trials", user_id)
+            analytics.inc("trial_converted")
+        logging.info(f"Payment {memo}: {inv['paid']} {inv['asset']}, {kind} +{inv['days']}d for {user_id}")
+        until = datetime.fromtimestamp(db[user_id], timezone.utc).strftime("%d.%m.%Y")
+        title = "Whale Alert" if kind == "main" else "P2P"
+        broadcaster.broadcast(f"✅ Оплата получена! Подписка {title} активна до {until}.", [user_id])
+
+payments = PaymentReconciler(parse_payment_sources(PAYMENT_SOURCES), PAYMENT_POLL_INTERVAL, PAYMENT_TOLERANCE)
+
+# === АНАЛИТИКА ===
+# Бизнес-счётчики для админа: обновляются в момент события и уходят в хранилище вместе
+# с остальными изменениями; отчёт читает только их — без Sheets и без обхода истории.
+# Каждый счётчик ведётся и за всё время, и за день ("имя|2024-01-31").
+# Ключи в хранилище "имя@воркер", чтобы воркеры не затирали друг друга; сумма — при чтении
+class Analytics:
+    def __init__(self, worker_id: int, keep_days: int):
+        self.suffix = f"@{worker_id}"
+        self.keep_days = keep_days
+        self.counters = {}
+        self._day = None
+
+    def load(self):
+        rows = store.load("stats")
+        self.counters = {
+            k[:-len(self.suffix)]: v for k, v in rows.items() if k.endswith(self.suffix) and math.isfinite(v)
+        }
+
+    @staticmethod
+    def day(offset: int = 0) -> str:
+        return (datetime.now(timezone.utc) + timedelta(days=offset)).strftime("%Y-%m-%d")
+
+    def inc(self, name: str, value: float = 1):
+        # NaN (нет курса для суммы) однажды попав в счётчик, испортил бы его навсегда
+        if not value or not math.isfinite(value):
+            return
+        day = self.day()
+        if day != self._day:
+            # смена суток: старые дневные ключи больше не пишутся, в памяти они не нужны
+            self._day = day
+            for key in [k for k in self.counters if "|" in k and k.rpartition("|")[2] < self.day(-self.keep_days)]:
+                del self.counters[key]
+        for key in (name, f"{name}|{day}"):
+            self.counters[key] = self.counters.get(key, 0) + value
+            store.put("stats", key + self.suffix, self.counters[key])
+
+    def set(self, name: str, value: float):
+        # текущее значение, а не счётчик; пишет один воркер, поэтому сумма по воркерам верна
+        if self.counters.get(name) != value:
+            self.counters[name] = value
+            store.put("stats", name + self.suffix, value)
+
+    @staticmethod
+    def usd(asset: str, amount: float) -> float:
+        i = rate_matrix.index.get(asset)
+        price = rate_matrix.usd[i] if i is not None else np.nan
+        return 0.0 if np.isnan(price) else float(amount * price)
+
+    async def totals(self) -> dict:
+        if not SHARED_STATE:
+            return dict(self.counters)
+        await store.flush()
+        totals = {}
+        for key, value in (await asyncio.to_thread(store.load, "stats")).items():
+            if not math.isfinite(value):
+                continue
+            name = key.rpartition("@")[0]
+            totals[name] = totals.get(name, 0) + value
+        return totals
+
+    async def prune(self):
+        # дневные ключи всех воркеров: дайджест запускает только воркер 0
+        cutoff = self.day(-self.keep_days)
+        for key in [k for k in self.counters if "|" in k and k.rpartition("|")[2] < cutoff]:
+            del self.counters[key]
+        await store.flush()
+        for key in await asyncio.to_thread(store.load, "stats"):
+            name = key.rpartition("@")[0]
+            if "|" in name and name.rpartition("|")[2] < cutoff:
+                store.delete("stats", key)
+
+    async def digest_forever(self):
+        # раз в сутки в STATS_DIGEST_HOUR (UTC) — сводка за вчера
+        while True:
+            now = datetime.now(timezone.utc)
+            at = now.replace(hour=STATS_DIGEST_HOUR, minute=0, second=0, microsecond=0)
+            if at <= now:
+                at += timedelta(days=1)
+            await asyncio.sleep((at - now).total_seconds())
+            try:
+                await self.prune()
+                text = format_stats(await self.totals(), self.day(-1), "вчера")
+                broadcaster.broadcast(text, [ADMIN_CHAT_ID], parse_mode="HTML")
+            except Exception as e:
+                logging.error(f"Stats digest error: {e}")
+
+analytics = Analytics(WORKER_ID, STATS_KEEP_DAYS)
+
+def format_stats(totals: dict, day: str, label: str) -> str:
+    def pair(name, fmt="{:,.0f}"):
+        return f"{fmt.format(totals.get(name, 0))} / {fmt.format(totals.get(f'{name}|{day}', 0))}"
+
+    new, converted = totals.get("users_new", 0), totals.get("trial_converted", 0)
+    conversion = f"{converted / new:.1%}" if new else "—"
+    pairs = sorted(
+        ((k.partition(":")[2], v) for k, v in totals.items() if k.startswith("pair:") and "|" not in k),
+        key=lambda kv: -kv[1]
+    )[:5]
+    msg = (
+        f"📊 <b>Статистика</b> (всего / {label})\n"
+        f"👥 Новые пользователи: {pair('users_new')}\n"
+        f"💎 Активные подписки: основная {totals.get('subs_active:main', 0):,.0f}, P2P {totals.get('subs_active:p2p', 0):,.0f}\n"
+        f"🎁 Пробные → оплата: {conversion} ({converted:,.0f} из {new:,.0f})\n"
+        f"💰 Оплаты: {pair('payments')} · выручка {pair('revenue_usd', '${:,.0f}')}\n"
+        f"📋 Заявки P2P: {pair('orders')} · объём {pair('volume_usd', '${:,.0f}')} · комиссии {pair('fees_usd', '${:,.2f}')}\n"
+    )
+    if pairs:
+        msg += "🔝 Пары:\n" + "".join(
+            f"• {p.replace('/', ' → ')}: {n:,.0f} (${totals.get(f'pair_usd:{p}', 0):,.0f})\n" for p, n in pairs
+        )
+    return msg
+
+# === РАССЫЛКА ===
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def take(self) -> float:
+        # 0 — токен взят, иначе сколько секунд подождать
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while (wait := self.take()) > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class Broadcast:
+    def __init__(self, bid: int, total: int):
+        self.id = bid
+        self.total = total
+        self.sent = self.failed = self.pruned = 0
+        self.latencies = []
+        self.started = time.monotonic()
+        self.done = asyncio.Event()
+        if not total:
+            self.done.set()
+
+    def finish_one(self, latency: float = None, pruned: bool = False):
+        if latency is not None:
+            self.sent += 1
+            self.latencies.append(latency)
+        else:
+            self.failed += 1
+            self.pruned += pruned
+        if self.sent + self.failed >= self.total:
+            self.done.set()
+            logging.info(f"Broadcast #{self.id}: {self.report()}")
+
+    def report(self) -> str:
+        lat = sorted(self.latencies) or [0.0]
+        p = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))]
+        return (
+            f"{self.sent}/{self.total} sent, {self.failed} failed ({self.pruned} blocked), "
+            f"latency p50={p(0.5):.2f}s p95={p(0.95):.2f}s max={lat[-1]:.2f}s, "
+            f"took {time.monotonic() - self.started:.1f}s"
+        )
+
+# Рассылка по подписчикам: общий токен-бакет под глобальный лимит Telegram,
+# интервал на чат, пул воркеров; платные подписчики получают раньше пробных
+class Broadcaster:
+    def __init__(self, rate: float, chat_interval: float, workers: int, retries: int):
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_interval = chat_interval
+        self.workers = workers
+        self.retries = retries
+        self.queue = asyncio.PriorityQueue()
+        self.bot = None
+        self._next_send = {}
+        self._seq = 0
+        self._ids = 0
+        self._tasks = []
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def broadcast(self, text: str, chat_ids, **kwargs) -> Broadcast:
+        chat_ids = list(chat_ids)
+        self._ids += 1
+        job = Broadcast(self._ids, len(chat_ids))
+        now = time.monotonic()
+        for chat_id in chat_ids:
+            self._put(1 if is_trial(chat_id) else 0, [chat_id, text, kwargs, job, now, 0])
+        return job
+
+    def _put(self, priority: int, item: list):
+        self._seq += 1
+        self.queue.put_nowait((priority, self._seq, item))
+
+    def _chat_wait(self, chat_id: int) -> float:
+        now = time.monotonic()
+        ready = self._next_send.get(chat_id, 0.0)
+        if ready > now:
+            return ready - now
+        self._next_send[chat_id] = now + self.chat_interval
+        if len(self._next_send) > 100000:
+            self._next_send = {c: t for c, t in self._next_send.items() if t > now}
+        return 0.0
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, seq, item = await self.queue.get()
+            chat_id, text, kwargs, job, enqueued, attempts = item
+            wait = self._chat_wait(chat_id)
+            if wait:
+                loop.call_later(wait, self.queue.put_nowait, (priority, seq, item))
+                continue
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                job.finish_one(time.monotonic() - enqueued)
+            except RetryAfter as e:
+                self.bucket.pause(float(e.retry_after))
+                self._put(priority, item)
+            except Forbidden:
+                prune_chat(chat_id)
+                job.finish_one(pruned=True)
+            except (TimedOut, NetworkError) as e:
+                item[5] += 1
+                if item[5] <= self.retries:
+                    loop.call_later(2 ** item[5], self._put, priority, item)
+                else:
+                    logging.warning(f"Broadcast to {chat_id} failed: {e}")
+                    job.finish_one()
+            except Exception as e:
+                logging.warning(f"Broadcast to {chat_id} failed: {e}")
+                job.finish_one()
+
+broadcaster = Broadcaster(BROADCAST_RATE, BROADCAST_CHAT_INTERVAL, BROADCAST_WORKERS, BROADCAST_RETRIES)
+metrics.gauge("bot_broadcast_queue", "Сообщений в очереди рассылки", lambda: broadcaster.queue.qsize())
+
+def prune_chat(chat_id: int):
+    # пользователь заблокировал бота — больше не шлём, пока не вернётся через /start;
+    # подписка остаётся в active, получателей фильтрует blocked_users
+    blocked_users[chat_id] = time.time()
+    save_db("blocked", chat_id)
+
+# === КНОПКИ ===
+# Маршрутизация нажатий: callback_data = "префикс:арг:арг", префикс ищется в словаре,
+# аргументы приводятся к типам из регистрации и передаются в обработчик готовыми.
+# Один CallbackQueryHandler на всё меню, стоимость не зависит от числа маршрутов
+class CallbackRouter:
+    MAX_BYTES = 64  # лимит Telegram на callback_data
+
+    def __init__(self):
+        self.routes = {}  # префикс -> (обработчик, типы аргументов)
+
+    def route(self, prefix: str, *types):
+        def register(callback):
+            if prefix in self.routes:
+                raise ValueError(f"Callback prefix {prefix!r} already registered")
+            self.routes[prefix] = (instrumented(callback, callback.__name__), types)
+            return callback
+        return register
+
+    def data(self, prefix: str, *args) -> str:
+        data = ":".join((prefix, *map(str, args)))
+        if data.count(":") != len(args) or len(data.encode()) > self.MAX_BYTES:
+            raise ValueError(f"Bad callback_data: {data!r}")
+        return data
+
+    def resolve(self, data: str):
+        prefix, *raw = (data or "").split(":")
+        route = self.routes.get(prefix)
+        if route is None or len(raw) != len(route[1]):
+            return None
+        callback, types = route
+        return callback, [t(a) for t, a in zip(types, raw)]
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        try:
+            resolved = self.resolve(query.data)
+        except ValueError:
+            resolved = None
+        if resolved is None:
+            # кнопки старых сообщений и чужие данные
+            await query.answer("Меню устарело, откройте /start")
+            return
+        callback, args = resolved
+        await callback(update, context, *args)
+
+router = CallbackRouter()
 
 # === КОМАНДЫ ===
+@router.route("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    if blocked_users.pop(user_id, None):
+        save_db("blocked", user_id)
     is_new = user_id not in subs_db and user_id not in user_memos
     if is_new:
-        subs_db[user_id] = (datetime.now(timezone.utc) + timedelta(days=1)).timestamp()
-        save_db()
+        subs_db[user_id] = trials[user_id] = (datetime.now(timezone.utc) + timedelta(days=1)).timestamp()
+        save_db("subs", user_id)
+        save_db("trials", user_id)
+        subscriptions.track(user_id, "main")
+        analytics.inc("users_new")
         trial = "🎁 <b>Добро пожаловать!</b> Пробный день активирован!\n\n"
     else:
         trial = ""
@@ -247,61 +2232,62 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "💎 <b>100 ⭐ = 175 RUB</b>"
     )
     kb = [
-        [InlineKeyboardButton("💎 Оплатить", callback_data="pay_main")],
-        [InlineKeyboardButton("🔁 P2P", callback_data="p2p_main")],
-        [InlineKeyboardButton("📄 Помощь", callback_data="help_main")]
+        [InlineKeyboardButton("💎 Оплатить", callback_data=router.data("pay"))],
+        [InlineKeyboardButton("🔁 P2P", callback_data=router.data("p2p"))],
+        [InlineKeyboardButton("📄 Помощь", callback_data=router.data("help"))]
     ]
-    await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode="HTML")
+    await update.effective_message.reply_text(msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode="HTML")
 
+@router.route("pay")
 async def pay_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     kb = [
-        [InlineKeyboardButton("🐋 Основная", callback_data="paytype_main")],
-        [InlineKeyboardButton("🔁 Только P2P", callback_data="paytype_p2p")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_start")]
+        [InlineKeyboardButton("🐋 Основная", callback_data=router.data("pt", "main"))],
+        [InlineKeyboardButton("🔁 Только P2P", callback_data=router.data("pt", "p2p"))],
+        [InlineKeyboardButton("⬅️ Назад", callback_data=router.data("start"))]
     ]
     await query.message.edit_text("Выберите тип:", reply_markup=InlineKeyboardMarkup(kb))
 
-async def handle_paytype(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@router.route("pt", str)
+async def handle_paytype(update: Update, context: ContextTypes.DEFAULT_TYPE, pt: str):
     query = update.callback_query
     await query.answer()
-    pt = query.data.replace("paytype_", "")
     kb = []
-    plans = [(3,500),(7,1000),(14,1800),(30,3500)] if pt == "main" else [("30d",30,"Пробный"),("90d",100,"3 мес"),("180d",280,"6 мес")]
+    plans = MAIN_PLANS if pt == "main" else P2P_PLANS
     for item in plans:
         if pt == "main":
             days, stars = item
             rub = stars * STARS_TO_RUB
-            kb.append([InlineKeyboardButton(f"{days} дн. — {stars} ⭐ ({rub:.0f} RUB)", callback_data=f"plan_{pt}_{days}")])
+            kb.append([InlineKeyboardButton(f"{days} дн. — {stars} ⭐ ({rub:.0f} RUB)", callback_data=router.data("plan", pt, days))])
         else:
             pid, stars, desc = item
             rub = stars * STARS_TO_RUB
-            kb.append([InlineKeyboardButton(f"{desc} — {stars} ⭐ ({rub:.0f} RUB)", callback_data=f"plan_{pt}_{pid}")])
-    kb.append([InlineKeyboardButton("⬅️ Назад", callback_data="pay_main")])
+            kb.append([InlineKeyboardButton(f"{desc} — {stars} ⭐ ({rub:.0f} RUB)", callback_data=router.data("plan", pt, pid))])
+    kb.append([InlineKeyboardButton("⬅️ Назад", callback_data=router.data("pay"))])
     await query.message.edit_text("Выберите тариф:", reply_markup=InlineKeyboardMarkup(kb))
 
-async def handle_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@router.route("plan", str, str)
+async def handle_plan(update: Update, context: ContextTypes.DEFAULT_TYPE, typ: str, plan_id: str):
     query = update.callback_query
     await query.answer()
-    _, typ, plan_id = query.data.split("_")
     user_id = update.effective_user.id
     if user_id not in user_memos:
         user_memos[user_id] = generate_memo(user_id)
-        save_db()
+        save_db("memos", user_id)
     context.user_data["pay_data"] = {"type": typ, "plan": plan_id}
     kb = [
-        [InlineKeyboardButton("⭐ Stars (100 ⭐ = 175 RUB)", callback_data="paymethod_stars")],
-        [InlineKeyboardButton("💎 Крипта", callback_data="paymethod_crypto")],
-        [InlineKeyboardButton("💰 Фиат", callback_data="paymethod_fiat")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data=f"paytype_{typ}")]
+        [InlineKeyboardButton("⭐ Stars (100 ⭐ = 175 RUB)", callback_data=router.data("pm", "stars"))],
+        [InlineKeyboardButton("💎 Крипта", callback_data=router.data("pm", "crypto"))],
+        [InlineKeyboardButton("💰 Фиат", callback_data=router.data("pm", "fiat"))],
+        [InlineKeyboardButton("⬅️ Назад", callback_data=router.data("pt", typ))]
     ]
     await query.message.edit_text("Способ оплаты:", reply_markup=InlineKeyboardMarkup(kb))
 
-async def handle_paymethod(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@router.route("pm", str)
+async def handle_paymethod(update: Update, context: ContextTypes.DEFAULT_TYPE, method: str):
     query = update.callback_query
     await query.answer()
-    method = query.data.replace("paymethod_", "")
     user_id = update.effective_user.id
     if method == "stars":
         await query.message.edit_text(f"⭐ Переведите Stars на:\n• Бот: {TAXOBOT_USERNAME}\n• ID: {NICEGRAM_ID}", parse_mode="HTML")
@@ -310,33 +2296,51 @@ async def handle_paymethod(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.edit_text(f"💰 Реквизиты: <code>{YOOMONEY_WALLET}</code>\nКомментарий: <code>{memo}</code>", parse_mode="HTML")
     elif method == "crypto":
         assets = ["TON", "ETH", "SOL", "DOGE", "USDT"]
-        kb = [[InlineKeyboardButton(a, callback_data=f"payasset_{a}") for a in assets[i:i+2]] for i in range(0, len(assets), 2)]
-        kb.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"plan_{context.user_data['pay_data']['type']}_{context.user_data['pay_data']['plan']}")])
+        kb = [[InlineKeyboardButton(a, callback_data=router.data("pa", a)) for a in assets[i:i+2]] for i in range(0, len(assets), 2)]
+        kb.append([InlineKeyboardButton("⬅️ Назад", callback_data=router.data("plan", context.user_data['pay_data']['type'], context.user_data['pay_data']['plan']))])
         await query.message.edit_text("Выберите актив:", reply_markup=InlineKeyboardMarkup(kb))
 
-async def select_pay_asset(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@router.route("pa", str)
+async def select_pay_asset(update: Update, context: ContextTypes.DEFAULT_TYPE, asset: str):
     query = update.callback_query
     await query.answer()
-    asset = query.data.replace("payasset_", "")
     user_id = update.effective_user.id
     memo = user_memos[user_id]
     address = PAYMENT_ADDRESSES.get(ASSET_TO_CHAIN.get(asset.upper(), "ton"), PAYMENT_ADDRESSES["ton"])
     network = NETWORK_NAMES.get(ASSET_TO_CHAIN.get(asset.upper(), "ton"), "Unknown")
+    url = f"ton://transfer/{address}?text={memo}" if asset == "TON" else address
+    caption = f"📄 Актив: {asset}\n🌐 Сеть: {network}\n📍 Адрес: <code>{address}</code>\n📎 MEMO: <code>{memo}</code>"
+    pay_data = context.user_data.get("pay_data") or {}
+    terms = plan_terms(pay_data.get("type"), pay_data.get("plan"))
+    # счёт и обещание автопродления — только если платежи в этом активе кто-то сверяет
+    amount = await plan_price(terms[1], asset) if terms and payments.covers(asset) else None
+    if amount:
+        inv = open_invoice(user_id, memo, pay_data["type"], pay_data["plan"], asset, amount)
+        caption += f"\n💰 Сумма: <code>{inv['amount'] - inv['paid']:.4g}</code> {asset}"
+        if inv["paid"]:
+            caption += f" (получено {inv['paid']:.4g} из {inv['amount']:g})"
+        caption += "\n✅ Подписка продлится автоматически после поступления"
+    file_id = qr_file_ids.get(url)
+    if file_id:
+        metrics.inc("bot_qr_cache_total", result="file_id")
+        try:
+            await context.bot.send_photo(chat_id=query.message.chat_id, photo=file_id, caption=caption, parse_mode="HTML")
+            return
+        except BadRequest:
+            qr_file_ids.pop(url, None)
+            save_db("qr_file_ids", url)
     waiting = await send_waiting(query.message.chat_id, context.bot)
     try:
-        qr = qrcode.QRCode(box_size=5, border=2)
-        url = f"ton://transfer/{address}?text={memo}" if asset == "TON" else address
-        qr.add_data(url)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white")
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        caption = f"📄 Актив: {asset}\n🌐 Сеть: {network}\n📍 Адрес: <code>{address}</code>\n📎 MEMO: <code>{memo}</code>"
-        await context.bot.send_photo(chat_id=query.message.chat_id, photo=buf.getvalue(), caption=caption, parse_mode="HTML")
+        png = await qr_cache.render(url)
+        sent = await context.bot.send_photo(chat_id=query.message.chat_id, photo=png, caption=caption, parse_mode="HTML")
+        if sent.photo:
+            qr_file_ids[url] = sent.photo[-1].file_id
+            save_db("qr_file_ids", url)
     finally:
         await waiting.delete()
 
 # === P2P ===
+@router.route("p2p")
 async def p2p_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -345,13 +2349,13 @@ async def p2p_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("Доступ закрыт. Оплатите: /pay")
         return
     context.user_data["p2p_step"] = "give_asset"
-    kb = [[InlineKeyboardButton(a, callback_data=f"p2p_give_{a}") for a in ALL_ASSETS[i:i+3]] for i in range(0, len(ALL_ASSETS), 3)]
+    kb = [[InlineKeyboardButton(a, callback_data=router.data("give", a)) for a in ALL_ASSETS[i:i+3]] for i in range(0, len(ALL_ASSETS), 3)]
     await query.message.edit_text("💱 Отдам:", reply_markup=InlineKeyboardMarkup(kb))
 
-async def p2p_select_give(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@router.route("give", str)
+async def p2p_select_give(update: Update, context: ContextTypes.DEFAULT_TYPE, asset: str):
     query = update.callback_query
     await query.answer()
-    asset = query.data.replace("p2p_give_", "")
     context.user_data["p2p_data"] = {"give": asset}
     context.user_data["p2p_step"] = "give_amount"
     await query.message.edit_text(f"💰 Сумма (минимум: {get_min_amount(asset)}):")
@@ -362,6 +2366,8 @@ async def p2p_enter_give_amount(update: Update, context: ContextTypes.DEFAULT_TY
     asset = context.user_data["p2p_data"]["give"]
     try:
         amount = float(update.message.text)
+        if not math.isfinite(amount):
+            raise ValueError
         if asset == "RUB":
             if amount < 500 or amount % 10 != 0:
                 raise ValueError
@@ -373,27 +2379,36 @@ async def p2p_enter_give_amount(update: Update, context: ContextTypes.DEFAULT_TY
                 raise ValueError
         context.user_data["p2p_data"]["give_amount"] = amount
         context.user_data["p2p_step"] = "receive_asset"
-        kb = [[InlineKeyboardButton(a, callback_data=f"p2p_recv_{a}") for a in ALL_ASSETS[i:i+3]] for i in range(0, len(ALL_ASSETS), 3)]
+        kb = [[InlineKeyboardButton(a, callback_data=router.data("recv", a)) for a in ALL_ASSETS[i:i+3]] for i in range(0, len(ALL_ASSETS), 3)]
         await update.message.reply_text("💱 Получу:", reply_markup=InlineKeyboardMarkup(kb))
-    except:
+    except ValueError:
         await update.message.reply_text(f"Некорректная сумма. Минимум: {get_min_amount(asset)}")
 
-async def p2p_select_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@router.route("recv", str)
+async def p2p_select_receive(update: Update, context: ContextTypes.DEFAULT_TYPE, asset: str):
     query = update.callback_query
     await query.answer()
-    asset = query.data.replace("p2p_recv_", "")
-    data = context.user_data["p2p_data"]
-    data["receive"] = asset
-    waiting = await send_waiting(query.message.chat_id, context.bot)
+    data = context.user_data.get("p2p_data")
+    if not data or "give_amount" not in data:
+        await query.message.edit_text("❌ Данные формы утеряны.")
+        return
+    waiting = None
+    if not rate_matrix.is_fresh():
+        waiting = await send_waiting(query.message.chat_id, context.bot)
     try:
-        rate = await get_exchange_rate(data["give"], asset)
+        quote = await get_quote(data["give"], asset)
+        if quote is None:
+            await query.message.edit_text(f"❌ Курс {data['give']} → {asset} недоступен, попробуйте позже.")
+            return
+        rate, age = quote
+        data["receive"] = asset
         give_amt = data["give_amount"]
         receive_amt = give_amt * rate
         _, fee = calculate_receive_amount(data["give"], give_amt, asset)
         final_amt = receive_amt - fee
         data["receive_amount"] = final_amt
         data["fee"] = fee
-        similar = get_similar_offers(data["give"], asset)
+        similar = get_similar_offers(data["give"], asset, final_amt / give_amt if give_amt else None)
         msg = f"✅ Расчёт:\nОтдам: {give_amt} {data['give']}\nПолучу: {final_amt:.6f} {asset}\n"
         if fee > 0:
             msg += f"Комиссия: {fee:.6f} {asset} (0.01%)\n"
@@ -403,13 +2418,17 @@ async def p2p_select_receive(update: Update, context: ContextTypes.DEFAULT_TYPE)
             msg += "📋 Аналогичные:\n"
             for o in similar:
                 msg += f"• {o['give_amt']} {o['give']} → {o['receive_amt']:.2f} {o['receive']} ({o['contact']})\n"
+        if age < float("inf"):
+            msg += f"\n🕒 Курс обновлён {age:.0f} сек. назад"
         msg += "\n📤 Отправить?"
-        kb = [[InlineKeyboardButton("📤 Отправить", callback_data="p2p_publish")]]
+        kb = [[InlineKeyboardButton("📤 Отправить", callback_data=router.data("pub"))]]
         await query.message.edit_text(msg, reply_markup=InlineKeyboardMarkup(kb))
     finally:
-        await waiting.delete()
+        if waiting:
+            await waiting.delete()
 
 # ✅ КЛЮЧЕВОЕ ИСПРАВЛЕНИЕ: правильная проверка
+@router.route("pub")
 async def p2p_publish(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -422,83 +2441,399 @@ async def p2p_publish(update: Update, context: ContextTypes.DEFAULT_TYPE):
     give = p2p_data.get("give")
     give_amount = p2p_data.get("give_amount")
     receive = p2p_data.get("receive")
-    receive_amount = p2p_data.get("receive_amount", 0.0)
+    receive_amount = p2p_data.get("receive_amount")
     fee = p2p_data.get("fee", 0.0)
 
-    if not give or not receive or give_amount is None:
+    if not give or not receive or give_amount is None or receive_amount is None:
         await query.message.edit_text("❌ Неполные данные.")
         return
 
     p2p_usage[user_id] = p2p_usage.get(user_id, 0) + 1
-    order = {
-        "id": p2p_usage[user_id],
-        "from_coin": give,
-        "to_coin": receive,
-        "amount": give_amount,
-        "final_amount": receive_amount,
-        "fee": fee,
-        "contact": f"@{update.effective_user.username}" if update.effective_user.username else f"user{user_id}",
-        "timestamp": datetime.now(timezone.utc).isoformat()
-    }
-    if user_id not in exchange_orders:
-        exchange_orders[user_id] = []
-    exchange_orders[user_id].append(order)
-    if p2p_sheet:
-        try:
-            p2p_sheet.append_row([
-                datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
-                str(user_id),
-                order["from_coin"],
-                order["to_coin"],
-                str(order["amount"]),
-                order["contact"],
-                str(order["fee"]),
-                f"Nicegram ID: {NICEGRAM_ID}"
-            ])
-        except: pass
+    save_db("p2p_usage", user_id)
+    contact = f"@{update.effective_user.username}" if update.effective_user.username else f"user{user_id}"
+    order = exchange_orders.add(user_id, p2p_usage[user_id], give, receive, give_amount, receive_amount, fee, contact)
+    volume = analytics.usd(give, give_amount)
+    analytics.inc("orders")
+    analytics.inc(f"pair:{give}/{receive}")
+    analytics.inc(f"pair_usd:{give}/{receive}", volume)
+    analytics.inc("volume_usd", volume)
+    analytics.inc("fees_usd", analytics.usd(receive, fee))
+    sheet_writer.enqueue([
+        datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        str(user_id),
+        order.from_coin,
+        order.to_coin,
+        str(order.amount),
+        order.contact,
+        str(order.fee),
+        f"Nicegram ID: {NICEGRAM_ID}"
+    ])
     await query.message.edit_text("✅ Заявка опубликована!")
     context.user_data.pop("p2p_data", None)
 
+@router.route("help")
 async def help_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.message.edit_text("📄 Помощь:\n• /pay\n• /p2p\n• /my_offers")
+    await update.callback_query.message.edit_text("📄 Помощь:\n• /pay\n• /p2p\n• /my_offers\n• /chart TON 24h")
 
 async def my_offers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    orders = exchange_orders.get(uid, [])
+    orders = exchange_orders.user_orders(uid)
     if not orders:
         await update.message.reply_text("Нет заявок.")
         return
     msg = "📋 Ваши заявки:\n\n"
     for o in orders[-3:]:
-        msg += f"#{o['id']} | {o['from_coin']} → {o['to_coin']}\n"
+        msg += f"#{o.id} | {o.from_coin} → {o.to_coin}\n"
     await update.message.reply_text(msg)
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(format_stats(await analytics.totals(), analytics.day(), "сегодня"), parse_mode="HTML")
+
+CHART_RANGES = {"1h": ("1m", 60), "24h": ("1m", 1439), "7d": ("1h", 168), "30d": ("1h", 720), "1y": ("1d", 365)}
+
+async def chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = [a.upper() for a in context.args]
+    period = next((a.lower() for a in args if a.lower() in CHART_RANGES), "24h")
+    assets = [a for a in args if a in price_history.index]
+    if not assets:
+        await update.message.reply_text(f"Использование: /chart TON [USD] [{'|'.join(CHART_RANGES)}]")
+        return
+    asset, vs = assets[0], assets[1] if len(assets) > 1 else "USD"
+    res, count = CHART_RANGES[period]
+    series = price_history.series(asset, res, count, vs=vs)
+    valid = series[~np.isnan(series)]
+    if len(valid) < 2:
+        await update.message.reply_text("Нет данных за этот период: история копится с запуска бота.")
+        return
+    series = series[np.argmax(~np.isnan(series)):]  # история короче периода — без пустого начала
+    change = valid[-1] / valid[0] - 1
+    msg = (
+        f"📈 <b>{asset}/{vs}</b> · {period}\n"
+        f"<code>{sparkline(series)}</code>\n"
+        f"мин {valid.min():.6g} · макс {valid.max():.6g}\n"
+        f"сейчас {valid[-1]:.6g} ({change:+.2%})"
+    )
+    await update.message.reply_text(msg, parse_mode="HTML")
+
+# === СИНХРОНИЗАЦИЯ ===
+# При SHARED_STATE каждый воркер раз в SYNC_INTERVAL забирает из журнала изменений
+# чужие заявки и поля пользователей: от них зависят сигналы, напоминания, счета и /stats
+class StateSync:
+    TABLES = ("subs", "p2p_subs", "trials", "blocked", "invoices")
+
+    def __init__(self, interval: float, keep: float):
+        self.interval = interval
+        self.keep = keep
+        self.seq = 0
+        self._prune_seq = 0
+        self._pruned_at = time.time()
+
+    async def sync(self):
+        self.seq, changed = await store.changes_since(self.seq)
+        orders = {}
+        for (tbl, key), value in changed.items():
+            # свои ещё не записанные изменения свежее того, что лежит на диске
+            if (tbl, key) in store._pending:
+                continue
+            if tbl == "orders":
+                if value is not None and key % 16 != WORKER_ID % 16:
+                    orders[key] = value
+            elif tbl in self.TABLES and DB_TABLES[tbl].get(key) != value:
+                if value is None:
+                    DB_TABLES[tbl].pop(key, None)
+                else:
+                    DB_TABLES[tbl][key] = value
+                if tbl in ("subs", "p2p_subs"):
+                    subscriptions.track(key, "main" if tbl == "subs" else "p2p")
+        exchange_orders.merge(orders)
+        # журнал чистит один воркер: удаляются записи старше keep (но не старше 2 * keep)
+        if WORKER_ID == 0 and time.time() - self._pruned_at > self.keep:
+            await store.prune_changes(self._prune_seq)
+            self._prune_seq, self._pruned_at = self.seq, time.time()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                logging.error(f"State sync error: {e}")
+
+state_sync = StateSync(SYNC_INTERVAL, CHANGES_KEEP)
+
+# === СОСТОЯНИЕ ===
+# user_data (шаги мастера P2P, выбранный тариф) в общем хранилище: PTB сбрасывает
+# изменённые записи раз в PERSISTENCE_INTERVAL, а при SHARED_STATE запись идёт после
+# каждого апдейта и перед каждым подтягиваются записи, изменённые другими воркерами
+class StorePersistence(BasePersistence):
+    USER_TABLES = ("subs", "p2p_subs", "memos", "p2p_usage", "trials", "blocked")
+
+    def __init__(self, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self._versions = {}
+
+    async def get_user_data(self):
+        rows = store.load("user_data")
+        self._versions = {uid: row["v"] for uid, row in rows.items()}
+        return {uid: row["data"] for uid, row in rows.items()}
+
+    async def update_user_data(self, user_id, data):
+        if not data:
+            await self.drop_user_data(user_id)
+            return
+        self._versions[user_id] = time.time_ns()
+        store.put("user_data", user_id, {"v": self._versions[user_id], "data": data})
+
+    async def drop_user_data(self, user_id):
+        self._versions.pop(user_id, None)
+        store.delete("user_data", user_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        if not SHARED_STATE:
+            return
+        keys = [("user_data", user_id)] + [(tbl, user_id) for tbl in self.USER_TABLES]
+        found = await store.fetch(keys)
+        row = found.get(("user_data", user_id))
+        if row and row["v"] > self._versions.get(user_id, 0):
+            self._versions[user_id] = row["v"]
+            user_data.clear()
+            user_data.update(row["data"])
+        for tbl in self.USER_TABLES:
+            value = found.get((tbl, user_id))
+            if value is not None and DB_TABLES[tbl].get(user_id) != value:
+                DB_TABLES[tbl][user_id] = value
+                if tbl in ("subs", "p2p_subs"):
+                    subscriptions.track(user_id, "main" if tbl == "subs" else "p2p")
+
+    async def flush(self):
+        await store.flush()
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# === ОБНОВЛЕНИЯ ===
+# Параллельная обработка апдейтов: разные чаты — одновременно (до UPDATE_WORKERS),
+# апдейты одного чата — строго по очереди, чтобы шаги мастера P2P не гонялись
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # process_update в PTB помечен @final, поэтому вся логика — в do_process_update.
+    # Семафор базового класса не ограничивает: слот из своего занимается только после
+    # очереди чата, иначе апдейты одного чата держали бы слоты, ожидая друг друга
+    UNLIMITED = 2 ** 31 - 1
+
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        super().__init__(self.UNLIMITED)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = None
+        if isinstance(update, Update):
+            chat, user = update.effective_chat, update.effective_user
+            key = chat.id if chat else user.id if user else None
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+async def start_webhook(app: Application):
+    from aiohttp import web
+
+    async def receive(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), app.bot)
+        except Exception as e:
+            logging.warning(f"Bad webhook payload: {e}")
+            return web.Response(status=400)
+        await app.update_queue.put(update)
+        return web.Response()
+
+    web_app = web.Application()
+    web_app.router.add_post(f"/{WEBHOOK_PATH}", receive)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    # при SHARED_STATE несколько воркеров слушают один порт, ядро делит соединения
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT, reuse_port=SHARED_STATE or None).start()
+    await app.bot.set_webhook(
+        url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=Update.ALL_TYPES
+    )
+    return runner
+
+async def start_metrics():
+    from aiohttp import web
+
+    async def scrape(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    async def profile(request):
+        return web.Response(text=profiler.folded(reset="reset" in request.query), content_type="text/plain", charset="utf-8")
+
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", scrape)
+    if profiler:
+        web_app.router.add_get("/debug/profile", profile)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_LISTEN, METRICS_PORT + WORKER_ID).start()
+    return runner
+
 # === ЗАПУСК ===
-async def main():
-    logging.basicConfig(level=logging.INFO)
-    load_db()
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+def register_handlers(app: Application):
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("pay", lambda u, c: pay_main(u, c)))
     app.add_handler(CommandHandler("p2p", lambda u, c: p2p_main(u, c)))
     app.add_handler(CommandHandler("my_offers", my_offers))
-    app.add_handler(CallbackQueryHandler(pay_main, pattern="^pay_main$"))
-    app.add_handler(CallbackQueryHandler(p2p_main, pattern="^p2p_main$"))
-    app.add_handler(CallbackQueryHandler(help_main, pattern="^help_main$"))
-    app.add_handler(CallbackQueryHandler(handle_paytype, pattern="^paytype_"))
-    app.add_handler(CallbackQueryHandler(handle_plan, pattern="^plan_"))
-    app.add_handler(CallbackQueryHandler(handle_paymethod, pattern="^paymethod_"))
-    app.add_handler(CallbackQueryHandler(select_pay_asset, pattern="^payasset_"))
-    app.add_handler(CallbackQueryHandler(p2p_select_give, pattern="^p2p_give_"))
-    app.add_handler(CallbackQueryHandler(p2p_select_receive, pattern="^p2p_recv_"))
-    app.add_handler(CallbackQueryHandler(p2p_publish, pattern="^p2p_publish$"))
+    app.add_handler(CommandHandler("chart", chart))
+    app.add_handler(CommandHandler("stats", stats, filters=filters.Chat(ADMIN_CHAT_ID)))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, p2p_enter_give_amount))
-    app.add_handler(CallbackQueryHandler(start, pattern="^back_to_start$"))
-    await app.initialize()
+    for handler in app.handlers[0]:
+        name = handler.callback.__name__
+        if name == "<lambda>" and isinstance(handler, CommandHandler):
+            name = "/" + min(handler.commands)
+        handler.callback = instrumented(handler.callback, name)
+    # маршруты кнопок замеряются по отдельности, сам диспетчер — нет
+    app.add_handler(CallbackQueryHandler(router.dispatch))
+    if UPDATES_LOG:
+        app.add_handler(TypeHandler(Update, record_update), group=-1)
+    if SHARED_STATE:
+        app.add_handler(TypeHandler(Update, write_user_data), group=1)
+
+async def write_user_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # следующий шаг мастера может прийти на другой воркер — ждать таймера PTB нельзя
+    if update.effective_user:
+        await context.application.persistence.update_user_data(update.effective_user.id, context.user_data)
+        await store.flush()
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # запись входящего потока для воспроизведения в benchmarks.py handlers --replay
+    line = json.dumps({"t": time.time(), "update": update.to_dict()}, ensure_ascii=False)
+    with open(UPDATES_LOG, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    started = time.perf_counter()
+    store.open()
+    sheets = asyncio.create_task(asyncio.to_thread(init_sheets))
+    await http.start()
+    refresher = asyncio.create_task(rate_refresher())
+    sheet_writer.start()
+    builder = (
+        Application.builder().token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(UPDATE_WORKERS))
+        .persistence(StorePersistence(PERSISTENCE_INTERVAL))
+    )
+    if WEBHOOK_URL:
+        builder = builder.updater(None)
+    app = builder.build()
+    register_handlers(app)
+    # база и getMe в Telegram загружаются одновременно
+    await asyncio.gather(asyncio.to_thread(load_db), app.initialize())
     await app.start()
-    await app.updater.start_polling()
-    logging.info("✅ Бот запущен!")
-    await asyncio.Event().wait()
+    load_exchange_addresses()
+    whales = WhalePipeline(
+        parse_sources(WHALE_SOURCES), broadcast_signal, WHALE_THRESHOLD_USD,
+        WHALE_EXCHANGE_MIN_USD, WHALE_DEDUP_SIZE, WHALE_QUEUE_SIZE, WHALE_MAX_AGE
+    )
+    metrics.gauge("bot_whale_queue", "Пачек транзакций в очереди фильтра", whales.queue.qsize)
+    metrics_server = await start_metrics() if METRICS_PORT else None
+    if profiler:
+        profiler.start()
+    # рассылки и уведомления — только на одном воркере, иначе дубли
+    if WORKER_ID == 0:
+        broadcaster.start(app.bot)
+        subscriptions.start()
+        whales.start()
+        payments.start()
+    state_syncer = asyncio.create_task(state_sync.run()) if SHARED_STATE else None
+    digest = asyncio.create_task(analytics.digest_forever()) if WORKER_ID == 0 and STATS_DIGEST_HOUR >= 0 else None
+    webhook = None
+    if WEBHOOK_URL:
+        webhook = await start_webhook(app)
+    else:
+        await app.updater.start_polling()
+    logging.info(f"✅ Бот запущен за {time.perf_counter() - started:.2f} сек.!")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if profiler:
+            profiler.stop()
+        if metrics_server:
+            await metrics_server.cleanup()
+        if webhook:
+            await webhook.cleanup()
+        elif app.updater.running:
+            await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        refresher.cancel()
+        sheets.cancel()
+        if state_syncer:
+            state_syncer.cancel()
+        if digest:
+            digest.cancel()
+        await whales.stop()
+        await payments.stop()
+        await subscriptions.stop()
+        await broadcaster.stop()
+        await sheet_writer.stop()
+        await http.close()
+        await store.flush()
+        store.close()
+        price_history.flush()
 
 if __name__ == "__main__":
     asyncio.run(main())